@@ -0,0 +1,125 @@
+"""
+Content-addressed cache for preprocessed training artifacts.
+"""
+
+import hashlib
+import os
+import os.path as op
+import shutil
+
+def file_digest(path):
+    """
+    SHA-1 of the content of a file, or of the names and contents of the
+    files in a directory, or of nothing if there is no file
+    """
+    h = hashlib.sha1()
+    if path is not None and op.isdir(path):
+        for name in sorted(os.listdir(path)):
+            h.update(name)
+            h.update(file_digest(op.join(path, name)))
+    elif path is not None:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), ''):
+                h.update(block)
+    return h.hexdigest()
+
+def input_key(files, *params):
+    """
+    Key for an artifact built from files and parameters: changes whenever the
+    content of any of the files or the value of any parameter does
+    """
+    h = hashlib.sha1()
+    for path in files:
+        h.update(file_digest(path))
+    h.update(repr(params))
+    return h.hexdigest()
+
+def _entry_size(path):
+    if not op.isdir(path):
+        return op.getsize(path)
+    return sum(op.getsize(op.join(d, f)) for d, _, files in os.walk(path) for f in files)
+
+def remove_path(path):
+    """ Removes a file or a directory """
+    if op.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+class ArtifactCache(object):
+    """
+    A directory of artifacts named after their kind and input key. Entries
+    are files or directories; using an entry marks it as recently used, and
+    the least recently used ones are evicted once the cache grows beyond
+    max_size bytes (0 for no limit).
+    """
+    def __init__(self, cache_dir, max_size=0, log=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.log = log
+
+        if not op.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def path(self, kind, key):
+        return op.join(self.cache_dir, '%s-%s' % (kind, key))
+
+    def get(self, kind, key):
+        """ Returns the path of the cached artifact, or None on a miss """
+        path = self.path(kind, key)
+        if not op.exists(path):
+            self.log.info('Cache miss for %s %s.' % (kind, key[:12]))
+            return None
+
+        self.log.info('Cache hit for %s %s.' % (kind, key[:12]))
+        os.utime(path, None)
+        return path
+
+    def put(self, kind, key, write):
+        """
+        Adds an artifact by calling write with the path to write it to, then
+        evicts old entries; returns the path of the new entry
+        """
+        path = self.path(kind, key)
+        # write under a temporary name so that a crash never leaves a
+        # partial entry behind under the real one
+        tmp = '%s.tmp%d' % (path, os.getpid())
+        write(tmp)
+        if op.exists(path):
+            remove_path(path)
+        os.rename(tmp, path)
+
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        if self.max_size <= 0:
+            return
+
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = op.join(self.cache_dir, name)
+            if '.tmp' in name:
+                continue
+            entries.append((op.getmtime(path), _entry_size(path), path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            self.log.info('Evicting "%s" from the cache (%.1f MB).' % (op.basename(path), size / 1048576.))
+            remove_path(path)
+            total -= size
+
+def read_key(path):
+    """ Returns the input key recorded next to an artifact, if there is one """
+    if not op.exists(path + '.key'):
+        return None
+    with open(path + '.key', 'r') as f:
+        return f.read().strip()
+
+def write_key(path, key):
+    with open(path + '.key', 'w') as f:
+        f.write(key + '\n')
@@ -0,0 +1,19 @@
+import argparse
+import cPickle as pickle
+from utils import smart_open, FeatureStore
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('filein', type=str, help="Pickled feature file written by train_parser.py")
+parser.add_argument('dirout', type=str, help="Output feature store directory")
+
+args = parser.parse_args()
+
+with smart_open(args.filein, 'rb') as fin:
+    examples = pickle.load(fin)
+    max_feat_size = pickle.load(fin)
+
+store = FeatureStore.from_examples(examples, max_feat_size)
+store.save(args.dirout)
+
+print 'Converted %d examples (%d transitions) to "%s".' % (len(store), len(store.labels), args.dirout)
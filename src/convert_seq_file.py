@@ -0,0 +1,30 @@
+import argparse
+import os.path as op
+from smart_open import smart_open
+from utils import read_mappings, transsys_lookup, iter_blocks, seq_lines_to_vectors, seq_line_from_vector, SeqFile, SeqWriter
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('filein', type=str, help="Input oracle sequence file, text or binary")
+parser.add_argument('fileout', type=str, help="Output oracle sequence file, in the other format")
+parser.add_argument('--transsys', type=str, choices=['Cov', 'NCov', 'Cov2', 'Cov3'], help="Transition system of the sequences", default="Cov")
+parser.add_argument('--mappings', default="mappings.txt", type=str, help="Mapping file for the dataset")
+
+args = parser.parse_args()
+
+mappings, invmappings = read_mappings(args.mappings, transsys_lookup(args.transsys))
+transsys = transsys_lookup(args.transsys)(mappings, invmappings)
+
+if op.isdir(args.filein):
+    # binary to text
+    with open(args.fileout, 'w') as fout:
+        for vector_forms in SeqFile.load(args.filein):
+            for vector_form in vector_forms:
+                fout.write("%s\n" % seq_line_from_vector(vector_form, invmappings))
+            fout.write("\n")
+else:
+    writer = SeqWriter(args.fileout)
+    with smart_open(args.filein, 'r') as fin:
+        for lines in iter_blocks(fin):
+            writer.write(seq_lines_to_vectors(lines, mappings, transsys))
+    writer.close()
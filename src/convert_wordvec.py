@@ -0,0 +1,17 @@
+import argparse
+import logging
+from utils import convert_wordvecs
+
+logging.basicConfig(format="%(asctime)-15s %(levelname)s %(filename)s:%(lineno)d] %(message)s", level=logging.INFO)
+log = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('filein', type=str, help="Word vector text file, e.g. GloVe")
+parser.add_argument('fileout', type=str, help="Output .npy file; the words are written next to it with a .words extension")
+parser.add_argument('--wordvec_dim', default=100, type=int, help="Dimensionality of the word vectors")
+
+args = parser.parse_args()
+
+count = convert_wordvecs(args.filein, args.fileout, args.wordvec_dim, log=log)
+log.info('Converted %d word vectors to "%s".' % (count, args.fileout))
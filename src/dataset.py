@@ -0,0 +1,169 @@
+"""
+Sharded on-disk training datasets, for treebanks too large to hold in memory.
+"""
+
+import json
+import os
+import os.path as op
+import random
+import shutil
+import numpy as np
+from itertools import islice
+
+from utils import FeatureStore
+
+MANIFEST = 'manifest.json'
+
+def _shard_name(i):
+    return 'shard-%05d' % i
+
+class ShardedDataset(object):
+    """
+    A directory of shards, each holding the encoded sentences of a run of
+    examples (words, POS and optionally fine-grained POS as flat int32 arrays
+    with per-sentence offsets) next to their FeatureStore, plus a manifest
+    with the example counts and length statistics of every shard and of the
+    whole dataset. Shards are memory-mapped when read, so only the examples
+    in the shuffling pool take up memory.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(op.join(path, MANIFEST), 'r') as f:
+            self.manifest = json.load(f)
+
+        self.shards = self.manifest['shards']
+        self.max_sent_len = self.manifest['max_sent_len']
+        self.max_trans_len = self.manifest['max_trans_len']
+        self.max_feat_size = self.manifest['max_feat_size']
+
+    def __len__(self):
+        return self.manifest['examples']
+
+    @staticmethod
+    def exists(path, key=None):
+        """ Whether a complete dataset built from inputs with the given key is at path """
+        if not op.exists(op.join(path, MANIFEST)):
+            return False
+        with open(op.join(path, MANIFEST), 'r') as f:
+            return key is None or json.load(f).get('key') == key
+
+    @staticmethod
+    def looks_like_dataset(path):
+        """ Whether path is a directory holding nothing but the files of a (possibly partial) dataset """
+        if not op.isdir(path):
+            return False
+        names = os.listdir(path)
+        return all(name == MANIFEST or name.startswith('shard-') for name in names)
+
+    @classmethod
+    def build(cls, path, examples, featurize, shard_size=10000, fpos=False, key=None, log=None):
+        """
+        Writes the examples yielded by an iterator to shards of shard_size
+        examples, featurizing a shard at a time with featurize, which maps a
+        list of examples to their [feats, featsizes, labels] and maximum
+        feature size. The manifest is written last, so a dataset without one
+        is incomplete. Raises ValueError if something other than a dataset is
+        at path.
+        """
+        if op.exists(path):
+            # only ever delete what an earlier build left behind
+            if not cls.looks_like_dataset(path):
+                raise ValueError('"%s" exists and does not look like a sharded dataset, refusing to overwrite it' % (path))
+            shutil.rmtree(path)
+        os.makedirs(path)
+
+        examples = iter(examples)
+        shards = []
+        while True:
+            data = list(islice(examples, shard_size))
+            if len(data) == 0:
+                break
+
+            name = _shard_name(len(shards))
+            log.info('Writing %d examples to shard "%s"...' % (len(data), name))
+            res, max_feat_size = featurize(data)
+            FeatureStore.from_examples(res, max_feat_size).save(op.join(path, name))
+
+            fields = ['words', 'seq', 'pos', 'fpos'] if fpos else ['words', 'seq', 'pos']
+            sent_offsets = np.zeros(len(data)+1, dtype=np.int32)
+            sent_offsets[1:] = np.cumsum([len(t[0]) for t in data])
+            np.save(op.join(path, name, 'sent_offsets.npy'), sent_offsets)
+            for j, field in enumerate(fields):
+                if field != 'seq':
+                    np.save(op.join(path, name, '%s.npy' % field), np.concatenate([np.asarray(t[j], dtype=np.int32) for t in data]))
+
+            shards.append({'name': name,
+                           'examples': len(data),
+                           'max_sent_len': max(len(t[0]) for t in data),
+                           'max_trans_len': max(len(labels) for _, _, labels in res),
+                           'max_feat_size': max_feat_size})
+
+        manifest = {'key': key,
+                    'fpos': fpos,
+                    'examples': sum(s['examples'] for s in shards),
+                    'max_sent_len': max([-1] + [s['max_sent_len'] for s in shards]),
+                    'max_trans_len': max([-1] + [s['max_trans_len'] for s in shards]),
+                    'max_feat_size': max([-1] + [s['max_feat_size'] for s in shards]),
+                    'shards': shards}
+        with open(op.join(path, MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=1)
+
+        log.info('%d examples written to %d shards in "%s".' % (manifest['examples'], len(shards), path))
+        return cls(path)
+
+    def shard(self, i):
+        """
+        Returns the examples of shard i as (words, None, pos[, fpos]) tuples
+        of views, along with its FeatureStore; the oracle transitions
+        themselves are only kept in featurized form
+        """
+        path = op.join(self.path, self.shards[i]['name'])
+        fields = ['words', 'pos', 'fpos'] if self.manifest['fpos'] else ['words', 'pos']
+        arrays = [np.load(op.join(path, '%s.npy' % field), mmap_mode='r') for field in fields]
+        sent_offsets = np.load(op.join(path, 'sent_offsets.npy'))
+
+        data = []
+        for s0, s1 in zip(sent_offsets[:-1], sent_offsets[1:]):
+            t = [a[s0:s1] for a in arrays]
+            data.append(tuple(t[:1] + [None] + t[1:]))
+        return data, FeatureStore.load(path)
+
+    def example_dims(self, single=False):
+        """
+        Returns the length of every sentence, its transition steps and the
+        largest number of candidate transitions in them (see
+        FeatureStore.example_dims), read from the offsets of the shards alone
+        """
+        dims = []
+        for shard in self.shards:
+            path = op.join(self.path, shard['name'])
+            lengths = np.diff(np.load(op.join(path, 'sent_offsets.npy')))
+            dims.append(np.column_stack([lengths, FeatureStore.load(path).example_dims(single)]))
+        return np.concatenate(dims) if len(dims) > 0 else np.zeros((0, 3), dtype=np.int32)
+
+    def iter_examples(self, pool_size, rng=random):
+        """
+        Yields (example, features) pairs in a random order: shards are read
+        in a shuffled order and their examples pass through a pool of
+        pool_size examples, from which a random one is drawn every time a new
+        one comes in
+        """
+        order = range(len(self.shards))
+        rng.shuffle(order)
+
+        pool = []
+        for i in order:
+            data, feats = self.shard(i)
+            for j in xrange(len(data)):
+                item = (data[j], feats[j])
+                if len(pool) < pool_size:
+                    pool.append(item)
+                    continue
+
+                k = rng.randrange(pool_size)
+                yield pool[k]
+                pool[k] = item
+
+        rng.shuffle(pool)
+        for item in pool:
+            yield item
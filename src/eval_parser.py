@@ -8,10 +8,10 @@ import sys
 import os.path as op
 import numpy as np
 
-from utils import process_example, read_data, read_vocab, read_mappings, featurize_state
+from utils import process_example, iter_data, scan_lengths, read_vocab, read_mappings, featurize_state, pack_batches
 from layers import DenseLayer
-from transition import Covington, NewCovington, Covington2, Covington3
-from parserstate import ParserState
+from transition import Covington, NewCovington, Covington2, Covington3, BatchedNewCovington
+from parserstate import ParserState, BeamNode
 
 from parser import Parser
 from init_argparse import init_argparse
@@ -19,6 +19,7 @@ from init_argparse import init_argparse
 from time import time
 from heapq import nlargest, heappush, heappushpop, nsmallest
 from itertools import izip
+from collections import Counter
 
 floatX = np.float32
 
@@ -26,25 +27,117 @@ tf.logging.set_verbosity(tf.logging.WARN)
 logging.basicConfig(format="%(asctime)-15s %(levelname)s %(filename)s:%(lineno)d] %(message)s")
 log = logging.getLogger(__name__)
 
+def batched_beam_search(sess, parser, transsys, args, batch_data, feat_dim, feed_dict):
+    """
+    Beam search over a batch of sentences with NewCovington, advancing all
+    hypotheses at once with BatchedNewCovington. Row i * beam_size + k
+    holds hypothesis k of sentence i. Returns, for every sentence, the
+    heap of finished (score, lattice node) pairs.
+    """
+    batch_size = len(batch_data)
+    beam_size = args.beam_size
+    rows = batch_size * beam_size
+
+    engine = BatchedNewCovington(transsys, [len(datum[0]) for datum in batch_data for _ in xrange(beam_size)])
+    scores = [0] * rows
+    nodes = [BeamNode(0)] * rows
+    alive = [k == 0 for _ in xrange(batch_size) for k in xrange(beam_size)]
+
+    batch_trans_feat_ids = np.zeros((rows, feat_dim, 5), dtype=np.int32)
+    batch_trans_feat_sizes = np.zeros((rows), dtype=np.int32)
+    batch_finished = [[] for _ in xrange(batch_size)]
+
+    while True:
+        feats, sizes = engine.featurize(feat_dim)
+
+        live = []
+        for r in xrange(rows):
+            if not alive[r]:
+                continue
+            if sizes[r] > 0:
+                live.append(r)
+                continue
+            i = r // beam_size
+            if len(batch_finished[i]) < beam_size:
+                heappush(batch_finished[i], (scores[r], nodes[r]))
+            else:
+                heappushpop(batch_finished[i], (scores[r], nodes[r]))
+
+        if len(live) <= 0:
+            break
+
+        batch_trans_feat_ids[:] = feats
+        batch_trans_feat_sizes[:] = sizes
+        feed_dict[parser.trans_feat_ids] = batch_trans_feat_ids
+        feed_dict[parser.trans_feat_sizes] = batch_trans_feat_sizes
+        p = np.array(sess.run([parser.trans_predictors[r // beam_size][r % beam_size] for r in live], feed_dict=feed_dict))
+
+        # same selection as the per-state loop in eval()
+        masks = engine.transition_masks(parser.pred_output_size)[live]
+        ranked = np.argsort(np.where(masks, p, np.inf), axis=1, kind='mergesort')[:, :beam_size]
+        legal = masks.sum(axis=1)
+
+        next_beams = [[] for _ in xrange(batch_size)]
+        for r, pred, choices, nlegal in izip(live, p, ranked, legal):
+            i, k = divmod(r, beam_size)
+            for choice in choices[:nlegal]:
+                newscore = scores[r] - pred[choice]
+                candidate = (newscore, k, int(choice))
+                if len(next_beams[i]) < beam_size:
+                    heappush(next_beams[i], candidate)
+                elif newscore > next_beams[i][0][0]:
+                    heappushpop(next_beams[i], candidate)
+
+        parents = range(rows)
+        actions = [-1] * rows
+        alive = [False] * rows
+        next_scores = [0] * rows
+        for i in xrange(batch_size):
+            for k1, (score, k, choice) in enumerate(nlargest(beam_size, next_beams[i], key=lambda x:x[0])):
+                r = i * beam_size + k1
+                parents[r], actions[r], alive[r], next_scores[r] = i * beam_size + k, choice, True, score
+
+        heads, deps, rels = engine.advance(actions, parents)
+        next_nodes = [None] * rows
+        for r in xrange(rows):
+            if alive[r]:
+                arc = (int(heads[r]), int(deps[r]), int(rels[r])) if deps[r] >= 0 else None
+                next_nodes[r] = BeamNode(next_scores[r], nodes[parents[r]], actions[r], arc)
+        scores, nodes = next_scores, next_nodes
+
+    return batch_finished
+
 def eval(args):
     transsys_lookup = {"Cov": Covington, "NCov": NewCovington, "Cov2": Covington2, "Cov3": Covington3}
     transsys = transsys_lookup[args.transsys]
 
     vocab, vecs, pretrained = read_vocab(conll_file=args.conll_file, wordvec_file=args.wordvec_file, vocab_file=args.vocab_file, wordvec_dim=args.wordvec_dim, min_count=args.min_count, log=log)
     mappings, invmappings = read_mappings(args.mappings_file, transsys, log=log)
-    data, sent_length, trans_length = read_data(conll_file=args.conll_file, seq_file=args.seq_file, vocab=vocab, mappings=mappings, transsys=transsys, fpos=args.fpos, log=log)
+    # the examples are streamed batch by batch, and only their lengths are
+    # read up front to size the model
+    sent_length, trans_length = scan_lengths(args.conll_file, args.seq_file)
+    log.info('Max sentence length %d, max transition count %d.' % (sent_length, trans_length))
 
     if args.transsys == 'NCov':
         sent_length=70
         
-    feat_shape = [5] if args.transsys == 'Cov' else [sent_length, 5]
+    # a window bounds NCov states to Shift plus 2*window arcs
+    feat_dim = 2 * args.window + 1 if args.transsys == 'NCov' and args.window > 0 else sent_length
+    feat_shape = [5] if args.transsys == 'Cov' else [feat_dim, 5]
 
-    transsys = transsys(mappings, invmappings)
+    transition_class = transsys
+    transsys = transsys(mappings, invmappings, window=args.window)
 
-    parser = Parser(args, vecs, pretrained, mappings, invmappings, sent_length, trans_length, -1, log, train=False)
+    parser = Parser(args, vecs, pretrained, mappings, invmappings, sent_length, trans_length, feat_dim, log, train=False)
 
     trans_predictors = parser.trans_predictors
 
+    if args.budget_unit == 'tokens':
+        dims = lambda datum: (len(datum[0]),)
+    else:
+        # every hypothesis gets a row of candidate transitions
+        dims = lambda datum: (args.beam_size * (1 if args.transsys == 'Cov' else feat_dim),)
+
     log.info('Computational graph successfully built.')
     log.info('Setting up tensorflow session...')
 
@@ -62,33 +155,31 @@ def eval(args):
         log.info('Evaluating Epoch %3d...' % (epoch))
         saver.restore(sess, savedpath)
 
-        #print "aki empieza a crear los estados"
-        states = [[(0, ParserState(datum[0], transsys=transsys))] for datum in data]
-        #print "aki termina++++++++++++++++++++++++++++++++++++++++++++++"
+        data = iter_data(conll_file=args.conll_file, seq_file=args.seq_file, vocab=vocab, mappings=mappings, transsys=transition_class, fpos=args.fpos, log=log)
        
         with smart_open('%s/%s_pos_eval_beam_%d_output_epoch%d.txt' % (args.model_dir, args.eval_dataset, args.beam_size, epoch), 'w') as outf2:
             with smart_open('%s/%s_eval_beam_%d_output_epoch%d.txt' % (args.model_dir, args.eval_dataset, args.beam_size, epoch), 'w') as outf:
-                for batch in xrange((len(data)+args.batch_size-1) / args.batch_size):
+                for batch, batch_data in enumerate(pack_batches(data, args.batch_size, args.batch_budget, dims)):
                     #print "Empieza un nuevo batch"
-                    idx = range(batch * args.batch_size, min((batch+1) * args.batch_size, len(data)))
+                    batch_size = len(batch_data)
 
-                    batch_size = len(idx)
-
-                    batch_data = [data[i] for i in idx]
-                    batch_states = [states[i] for i in idx]
+                    # beam items are (score, parser state, lattice node); a
+                    # state is only kept while its hypothesis is alive, and
+                    # parses are read off the lattice once decoding is done
+                    batch_states = [[(0, ParserState(datum[0], transsys=transsys), BeamNode(0))] for datum in batch_data]
 
                     # prepare data in tensor shape
-                    batch_sent_lengths = np.array([len(datum[0]) for datum in batch_data] + [sent_length] * (args.batch_size - batch_size), dtype=np.int32)
-                    batch_words = np.zeros((args.batch_size, sent_length), dtype=np.int32)
-                    batch_words2 = np.zeros((args.batch_size, sent_length), dtype=np.int32)
-                    batch_gold_pos = np.zeros((args.batch_size, sent_length), dtype=np.int32)
+                    batch_sent_lengths = np.array([len(datum[0]) for datum in batch_data], dtype=np.int32)
+                    batch_words = np.zeros((batch_size, sent_length), dtype=np.int32)
+                    batch_words2 = np.zeros((batch_size, sent_length), dtype=np.int32)
+                    batch_gold_pos = np.zeros((batch_size, sent_length), dtype=np.int32)
                     for i in xrange(batch_size):
                         batch_words[i, :batch_sent_lengths[i]] = batch_data[i][0]
                         batch_words2[i, :batch_sent_lengths[i]] = batch_data[i][0]
                         batch_gold_pos[i, :batch_sent_lengths[i]] = batch_data[i][2]
 
-                    batch_trans_feat_ids = np.zeros(tuple([args.batch_size * args.beam_size] + feat_shape), dtype=np.int32)
-                    batch_trans_feat_sizes = np.zeros((args.batch_size * args.beam_size), dtype=np.int32)
+                    batch_trans_feat_ids = np.zeros(tuple([batch_size * args.beam_size] + feat_shape), dtype=np.int32)
+                    batch_trans_feat_sizes = np.zeros((batch_size * args.beam_size), dtype=np.int32)
 
                     preds_list = [parser.combined_head, parser.combined_dep, parser.pos_preds]
                     
@@ -130,6 +221,15 @@ def eval(args):
                     updated = range(batch_size)
                     batch_finished = [[] for _ in range(batch_size)]
 
+                    if isinstance(transsys, NewCovington):
+                        # all hypotheses are advanced at once, which leaves
+                        # nothing for the per-state loop below
+                        batch_finished = batched_beam_search(sess, parser, transsys, args, batch_data, feat_dim,
+                                                             {parser.combined_head_placeholder: batch_combined_head,
+                                                              parser.combined_dep_placeholder: batch_combined_dep,
+                                                              parser.trans_logit_placeholder: batch_trans_logit})
+                        updated = []
+
                     feat_lengths = [[] for _ in range(batch_size)]
 
                     #print 'dale_____________2222222______________________________'
@@ -158,10 +258,11 @@ def eval(args):
                         for i, beam_feats in zip(updated, batch_feats):
                             for k, feats in enumerate(beam_feats):
                                 if len(feats) <= 0:
+                                    finished = (batch_states[i][k][0], batch_states[i][k][2])
                                     if len(batch_finished[i]) < args.beam_size:
-                                        heappush(batch_finished[i], batch_states[i][k])
+                                        heappush(batch_finished[i], finished)
                                     else:
-                                        heappushpop(batch_finished[i], batch_states[i][k])
+                                        heappushpop(batch_finished[i], finished)
 
                                     continue
 
@@ -201,50 +302,42 @@ def eval(args):
                         next_batchstates = [[] for _ in xrange(batch_size)]
                         updated = set()
                        
-                        for ik, pred in izip(predsid, p):
+                        # model outputs NLLs so the lower the better; illegal
+                        # transitions are ranked last and never expanded
+                        p = np.array(p)
+                        masks = transsys.transition_masks([batch_states[i][k][1] for i, k in predsid], parser.pred_output_size)
+                        ranked = np.argsort(np.where(masks, p, np.inf), axis=1, kind='mergesort')[:, :args.beam_size]
+                        legal = masks.sum(axis=1)
+
+                        for ik, pred, choices, nlegal in izip(predsid, p, ranked, legal):
                             i, k = ik
 
                             updated.add(i)
-                            
-                            #print("deberia ser 0 al final", len(batch_states[i][k][1].transitionset()))
-                            if len(batch_states[i][k][1].transitionset()) > 0:
-                                # model outputs NLLs so the lower the better
-                                sort = sorted(enumerate(pred), key=lambda x: x[1])
-                                expanded_beams = 0
-                                for choice, score in sort:
-                                    newscore = batch_states[i][k][0] - score
-                                    
-                                    
-                                    #print 'transition set'
-                                    #print sort
-                                    #print( 'choice', choice)
-                                    
-                                    #print  transsys.tuple_trans_from_int(batch_states[i][k][1].transitionset(), choice)[0]
-                                    #print 'allowed antes de entrar'
-                                    #print  batch_states[i][k][1].transitionset() 
-                                    if transsys.tuple_trans_from_int(batch_states[i][k][1].transitionset(), choice)[0] in batch_states[i][k][1].transitionset():
-                                        candidate = (newscore, batch_states[i][k][1], choice)
-                                        if len(next_batchstates[i]) < args.beam_size:
-                                            heappush(next_batchstates[i], candidate)
-                                        elif newscore > next_batchstates[i][0][0]:
-                                            heappushpop(next_batchstates[i], candidate)
-                                        
-                                        #print 'candidadte'
-                                        #print candidate    
-                                        expanded_beams += 1
-                                        if expanded_beams >= args.beam_size:
-                                            break
-                        
+
+                            for choice in choices[:nlegal]:
+                                newscore = batch_states[i][k][0] - pred[choice]
+                                candidate = (newscore, k, int(choice))
+                                if len(next_batchstates[i]) < args.beam_size:
+                                    heappush(next_batchstates[i], candidate)
+                                elif newscore > next_batchstates[i][0][0]:
+                                    heappushpop(next_batchstates[i], candidate)
+
                         #print 'dale____________ini pred______________________________'
                        
                         for i in updated:
                             next_batchstates[i] = nlargest(args.beam_size, next_batchstates[i], key=lambda x:x[0])
-                            for k, t in enumerate(next_batchstates[i]):
+                            # the last surviving expansion of a hypothesis takes
+                            # over its state, the others work on clones of it
+                            expansions = Counter(t[1] for t in next_batchstates[i])
+                            for k1, t in enumerate(next_batchstates[i]):
                                 #print '------------config executing------------------'
-                                score, state, choice = t
-                                state = state.clone()
-                                transsys.advance(state, choice)
-                                next_batchstates[i][k] = (score, state)
+                                score, k, choice = t
+                                _, state, node = batch_states[i][k]
+                                expansions[k] -= 1
+                                if expansions[k] > 0:
+                                    state = state.clone()
+                                arc = transsys.advance(state, choice)
+                                next_batchstates[i][k1] = (score, state, BeamNode(score, node, choice, arc))
                                
                         #print 'dale____________fin pred______________________________'   
                          
@@ -257,9 +350,10 @@ def eval(args):
                         assert len(batch_finished) == batch_size
                         assert len(batch_finished[i]) > 0, "nothing finished: %d" % (i)
                         assert len(batch_finished[i][0]) > 1, "%s" % (batch_finished[i][0])
-                        state_pred = nlargest(1, batch_finished[i], key=lambda x:x[0])[0][1]
-                        for t in state_pred.head[1:]:
-                            outf.write("%d\t%s\n" % (t[0], invmappings['rel'][t[1]]))
+                        node_pred = nlargest(1, batch_finished[i], key=lambda x:x[0])[0][1]
+                        head, rel = node_pred.heads(len(batch_data[i][0]))
+                        for d in xrange(1, len(head)):
+                            outf.write("%d\t%s\n" % (head[d], invmappings['rel'][rel[d]]))
                         outf.write("\n") 
 
                     log.info('Epoch %3d batch %4d' % (epoch, batch))
@@ -2,24 +2,43 @@ import sys
 from parserstate import ParserState
 from transition import Covington, NewCovington, Covington2
 import argparse
-from utils import read_mappings, transsys_lookup, read_gold_parserstates, write_gold_trans
+from utils import read_mappings, transsys_lookup, iter_gold_trans, SeqWriter
 
 parser = argparse.ArgumentParser()
 
 parser.add_argument('filein', type=str, help="Input CONLL file")
-parser.add_argument('fileout', type=str, help="Output oracle sequence file")
-parser.add_argument('--transsys', type=str, choices=['Cov', 'NCov', 'Cov2', 'Cov3', 'DCov'], help="Transition system to use", default="Cov")
+parser.add_argument('fileout', type=str, help="Output oracle sequence file; with several transition systems it must contain {transsys}, which is replaced by the name of each")
+parser.add_argument('--transsys', type=str, help="Transition system to use, or several separated by commas (Cov, NCov, Cov2, Cov3, DCov)", default="Cov")
 parser.add_argument('--mappings', default="mappings.txt", type=str, help="Mapping file for the dataset")
-parser.add_argument('--fpos', default=False, action='store_true', help="Include fine-grained POS")
+parser.add_argument('--fpos', default=False, action='store_true', help="Ignored, fine-grained POS are always included")
+parser.add_argument('--window', default=0, type=int, help="Only allow NCov arcs to the first WINDOW words of list1, 0 for no limit; gold arcs further away are not built")
+parser.add_argument('--workers', default=1, type=int, help="Number of processes to generate the sequences with, 0 for one per CPU")
+parser.add_argument('--binary', default=False, action='store_true', help="Write binary sequence files (directories of int16 records) instead of text")
 
 args = parser.parse_args()
 
-mappings, invmappings = read_mappings(args.mappings, transsys_lookup(args.transsys))
-transsys = transsys_lookup(args.transsys)(mappings, invmappings)
+systems = args.transsys.split(',')
+for name in systems:
+    if name not in ['Cov', 'NCov', 'Cov2', 'Cov3', 'DCov']:
+        parser.error('unknown transition system "%s"' % (name))
+if len(systems) > 1 and '{transsys}' not in args.fileout:
+    parser.error('the output file must contain {transsys} when generating several transition systems')
 
+transsystems = []
+for name in systems:
+    mappings, invmappings = read_mappings(args.mappings, transsys_lookup(name))
+    transsystems += [transsys_lookup(name)(mappings, invmappings, window=args.window)]
+
+if args.binary:
+    fouts = [SeqWriter(args.fileout.replace('{transsys}', name)) for name in systems]
+else:
+    fouts = [open(args.fileout.replace('{transsys}', name), 'w') for name in systems]
+
+# the treebank is read once and every sentence is written for all systems
 with open(args.filein, 'r') as fin:
-    gold_states = read_gold_parserstates(fin, transsys, args.fpos)
+    for outs in iter_gold_trans(fin, transsystems, workers=args.workers, binary=args.binary):
+        for fout, out in zip(fouts, outs):
+            fout.write(out)
 
-with open(args.fileout, 'w') as fout:
-    for state in gold_states:
-        write_gold_trans(state, fout)
+for fout in fouts:
+    fout.close()
@@ -1,18 +1,33 @@
 def init_argparse(parser):
     parser.add_argument('conll_file', help="Input CoNLL file to train or evaluate on")
-    parser.add_argument('--seq_file', help="Oracle sequence for the parser", default=None, type=str)
-    parser.add_argument('--wordvec_file', help="File to read pretrained word vectors from", default=None, type=str)
+    parser.add_argument('--seq_file', help="Oracle sequence for the parser; when training without one, gold transitions are computed from the CoNLL file directly", default=None, type=str)
+    parser.add_argument('--wordvec_file', help="File to read pretrained word vectors from, either text or a .npy matrix made by convert_wordvec.py", default=None, type=str)
+    parser.add_argument('--filter_wordvecs', help="Only load pretrained vectors of words in the training data and the --wordvec_corpora", default=False, action='store_true')
+    parser.add_argument('--wordvec_corpora', help="Comma-separated CoNLL files (e.g. dev and test) whose words also keep their pretrained vectors with --filter_wordvecs", default='', type=str)
     parser.add_argument('--wordvec_dim', help="Dimensionality of word embeddings to be used", default=100, type=int)
     parser.add_argument('--vocab_file', help="File to save/read vocabulary to/from", default=None, type=str)
     parser.add_argument('--debug', help='Print debug outputs', default=False, action='store_true')
     parser.add_argument('--hidden_size', help='Number of hidden units in RNN', default=400, type=int)
     parser.add_argument('--layers', help='Number of layers in POS-RNN', default=2, type=int)
     parser.add_argument('--layers2', help='Number of layers in Parse-RNN', default=2, type=int)
-    parser.add_argument('--batch_size', help='Minibatch size used in SGD', default=32, type=int)
+    parser.add_argument('--batch_size', help='Minibatch size used in SGD, or the largest one with --batch_budget', default=32, type=int)
+    parser.add_argument('--batch_budget', help='Pack batches of up to this many padded cells instead of a fixed number of sentences, 0 to disable', default=0, type=int)
+    parser.add_argument('--budget_unit', help='What --batch_budget counts: words ("tokens", default) or transition steps by candidate transitions ("cells")', default="tokens", choices=["tokens", "cells"])
     parser.add_argument('--mappings_file', help='File storing mappings from dependency relations and POS tags to integers', default='mappings.txt', type=str)
     parser.add_argument('--dense_layers', help='Comma-separated sizes of dense layers following the Parse-BiLSTM; default "100"', default='100', type=str)
     parser.add_argument('--pos_dense_layers', help='Comma-separated sizes of dense layers following the POS-BiLSTM; default "100"', default='100', type=str)
     parser.add_argument('--feat_file', help="Files containing featurized examples", default=None, type=str)
+    parser.add_argument('--feat_format', help='Format to save new feature files in: a directory of memory-mapped arrays ("npy", default) or a pickle ("pickle"); both are read back', default="npy", choices=["npy", "pickle"])
+    parser.add_argument('--feat_workers', help='Number of processes to featurize the training data with, 0 for one per CPU', default=1, type=int)
+    parser.add_argument('--cache_dir', help='Directory to cache vocabularies and featurized examples in, keyed on their inputs', default=None, type=str)
+    parser.add_argument('--load_unkeyed', help='Reuse a --vocab_file or --feat_file that has no record of the inputs it was built from, as saved by older versions, instead of refusing to replace it', default=False, action='store_true')
+    parser.add_argument('--cache_size', help='Size limit of the cache in MB, least recently used entries are evicted beyond it; 0 for no limit', default=4096, type=int)
+    parser.add_argument('--dataset_dir', help='Directory of a sharded dataset to stream training examples from; built from the CoNLL and sequence files if missing or stale', default=None, type=str)
+    parser.add_argument('--shard_size', help='Number of examples per shard when building a sharded dataset', default=10000, type=int)
+    parser.add_argument('--shuffle_pool', help='Number of examples held in memory for shuffling when training from a sharded dataset', default=50000, type=int)
+    parser.add_argument('--buckets', help='Number of batches of shuffled examples sorted by length together, so that batches hold examples of similar lengths and need less padding; 1 to keep batches as shuffled', default=1, type=int)
+    parser.add_argument('--prefetch', help='Number of training batches assembled ahead by a background thread while the current one runs, 0 to assemble them on demand', default=4, type=int)
+    parser.add_argument('--flat_loss', help='Compute the transition loss of all steps of a batch at once with segment sums, instead of one step at a time', default=False, action='store_true')
     parser.add_argument('--rel_emb_dim', help="Dimensionality of relation embeddings to be used", default=32, type=int)
     parser.add_argument('--pos_emb_dim', help="Dimensionality of POS tag embeddings to be used", default=32, type=int)
     parser.add_argument('--epochs', help='Number of epochs to run', default=10, type=int)
@@ -24,6 +39,7 @@ def init_argparse(parser):
     parser.add_argument('--keep_prob', help='Probability of keeping activation in dropout', default=0.95, type=float)
     parser.add_argument('--combination', help='How vectors are combined; default "biaffine"', default="biaffine", choices=["affine", "bilinear", "biaffine"])
     parser.add_argument('--transsys', type=str, choices=['Cov', 'NCov', 'Cov2', 'Cov3'], help="Transition system to use", default="Cov")
+    parser.add_argument('--window', help='Only allow NCov arcs to the first WINDOW words of list1, 0 for no limit; must match the one used to generate the oracle', default=0, type=int)
     parser.add_argument('--eval_dataset', type=str, choices=['train', 'dev', 'test'], help="Dataset evaluating on", default="dev")
     parser.add_argument('--pos_mult', help='Multiplier for the POS loss', default=1.0, type=float)
     parser.add_argument('--word_dropout', help='Word dropout probability', default=0.1, type=float)
@@ -18,7 +18,7 @@ class Parser:
     def init_comp_graph(self, args, vecs, pretrained, mappings, invmappings, trans_length, feat_dim, log):
         keep_prob = args.keep_prob if self.train else 1.0
 
-        feat_shape = [5] if args.transsys == 'Cov' else ([feat_dim, 5] if self.train else [self.sent_length, 5])
+        feat_shape = [5] if args.transsys == 'Cov' else [feat_dim, 5]
 
         # build computational graph
         log.info('Building computational graph, this might take a while...')
@@ -31,9 +31,11 @@ class Parser:
         pretrained_emb = tf.add(pretrained_base, pretrained_delta)
         random_emb = tf.Variable(vecs[pretrained:])
         embeddings = tf.concat([pretrained_emb, random_emb], 0)
-        self.words = tf.placeholder(tf.int32, [args.batch_size, self.sent_length])
-        self.words2 = tf.placeholder(tf.int32, [args.batch_size, self.sent_length])
-        self.sent_lengths = tf.placeholder(tf.int32, [args.batch_size])
+        self.words = tf.placeholder(tf.int32, [None, self.sent_length])
+        self.words2 = tf.placeholder(tf.int32, [None, self.sent_length])
+        self.sent_lengths = tf.placeholder(tf.int32, [None])
+        # batches can hold any number of sentences up to args.batch_size
+        batch_size = tf.shape(self.words)[0]
         word_emb = tf.nn.embedding_lookup(embeddings, self.words)
         word_emb2 = tf.nn.embedding_lookup(embeddings, self.words2)
 
@@ -45,9 +47,9 @@ class Parser:
 
 
         # POS
-        self.gold_pos = tf.placeholder(tf.int32, [args.batch_size, self.sent_length])
+        self.gold_pos = tf.placeholder(tf.int32, [None, self.sent_length])
         if args.fpos:
-            self.gold_fpos = tf.placeholder(tf.int32, [args.batch_size, self.sent_length])
+            self.gold_fpos = tf.placeholder(tf.int32, [None, self.sent_length])
 
         # POS system
         log.debug('Building computational graph for the POS-tagging system...')
@@ -67,26 +69,27 @@ class Parser:
             for l in xrange(1, pos_denselayers-1):
                 pos_dense_intermediate = pos_dense[l](pos_dense_intermediate)
 
-            pos_dense_outputs = tf.reshape(pos_dense[-1](pos_dense_intermediate), [args.batch_size, -1, len(mappings['pos'])])
+            pos_dense_outputs = tf.reshape(pos_dense[-1](pos_dense_intermediate), [batch_size, -1, len(mappings['pos'])])
             if args.fpos:
                 fpos_dense = DenseLayer(args.pos_emb_dim, len(mappings['fpos']), keepProb=keep_prob, nl=lambda x:x)
-                fpos_dense_outputs = tf.reshape(fpos_dense(pos_dense_intermediate), [args.batch_size, -1, len(mappings['fpos'])])
+                fpos_dense_outputs = tf.reshape(fpos_dense(pos_dense_intermediate), [batch_size, -1, len(mappings['fpos'])])
         else:
-            pos_dense_outputs = [None for _ in range(args.batch_size)]
+            # POS tags come from the input, so there are no logits to predict them from
+            pos_dense_outputs = None
 
         pos_trainables = tf.Variable(tf.truncated_normal((len(mappings['pos']), args.pos_emb_dim)),
                 dtype=tf.float32, name='pos_trainables')
         pos_untrainable = tf.Variable(tf.zeros((1, args.pos_emb_dim), dtype=tf.float32), trainable=False)
         pos_embeddings = tf.concat([pos_trainables, pos_untrainable], 0)
 
-        pos_loss_pred_ = lambda i: self.pos_loss_pred(i, pos_embeddings, pos_dense_outputs[i], len(mappings['pos']), self.gold_pos, pos_trainables)
+        pos_loss_pred_ = lambda i: self.pos_loss_pred(i, pos_embeddings, None if pos_dense_outputs is None else pos_dense_outputs[i], len(mappings['pos']), self.gold_pos, pos_trainables)
 
         if self.train:
-            pos_losses = tf.multiply(args.pos_mult, tf.map_fn(lambda i: pos_loss_pred_(i)[0], tf.range(args.batch_size), parallel_iterations=args.batch_size, dtype=tf.float32))
+            pos_losses = tf.multiply(args.pos_mult, tf.map_fn(lambda i: pos_loss_pred_(i)[0], tf.range(batch_size), parallel_iterations=args.batch_size, dtype=tf.float32))
         else:
-            self.pos_preds = tf.map_fn(lambda i: pos_loss_pred_(i)[0], tf.range(args.batch_size), parallel_iterations=args.batch_size)
+            self.pos_preds = tf.map_fn(lambda i: pos_loss_pred_(i)[0], tf.range(batch_size), parallel_iterations=args.batch_size)
 
-        self.pos_embs = tf.map_fn(lambda i: pos_loss_pred_(i)[1], tf.range(args.batch_size), parallel_iterations=args.batch_size, dtype=tf.float32)
+        self.pos_embs = tf.map_fn(lambda i: pos_loss_pred_(i)[1], tf.range(batch_size), parallel_iterations=args.batch_size, dtype=tf.float32)
 
         if args.fpos:
             fpos_trainables = tf.Variable(tf.truncated_normal((len(mappings['fpos']), args.pos_emb_dim)),
@@ -97,12 +100,12 @@ class Parser:
             fpos_loss_pred_ = lambda i: self.pos_loss_pred(i, fpos_embeddings, fpos_dense_outputs[i], len(mappings['fpos']), self.gold_fpos, fpos_trainables)
 
             if self.train:
-                fpos_losses = tf.multiply(args.pos_mult, tf.map_fn(lambda i: fpos_loss_pred_(i)[0], tf.range(args.batch_size), parallel_iterations=args.batch_size, dtype=tf.float32))
+                fpos_losses = tf.multiply(args.pos_mult, tf.map_fn(lambda i: fpos_loss_pred_(i)[0], tf.range(batch_size), parallel_iterations=args.batch_size, dtype=tf.float32))
                 pos_losses = pos_losses + fpos_losses
             else:
-                self.fpos_preds = tf.map_fn(lambda i: fpos_loss_pred_(i)[0], tf.range(args.batch_size), parallel_iterations=args.batch_size)
+                self.fpos_preds = tf.map_fn(lambda i: fpos_loss_pred_(i)[0], tf.range(batch_size), parallel_iterations=args.batch_size)
 
-            self.fpos_embs = tf.map_fn(lambda i: fpos_loss_pred_(i)[1], tf.range(args.batch_size), parallel_iterations=args.batch_size, dtype=tf.float32)
+            self.fpos_embs = tf.map_fn(lambda i: fpos_loss_pred_(i)[1], tf.range(batch_size), parallel_iterations=args.batch_size, dtype=tf.float32)
 
         bilstm_outputs = tf.concat([bilstm_outputs[0], bilstm_outputs[1]], 2)
 
@@ -117,7 +120,7 @@ class Parser:
             concat_list += [self.fpos_embs]
             dim += args.pos_emb_dim
 
-        bilstm2_inputs = tf.reshape(tf.concat(concat_list, 2), [args.batch_size, -1, dim])
+        bilstm2_inputs = tf.reshape(tf.concat(concat_list, 2), [batch_size, -1, dim])
 
         # Parse BiLSTM
         log.debug('Building computational graph for the Parse-BiLSTM...')
@@ -150,7 +153,7 @@ class Parser:
 
             dense_outputs = [dense[-1][j](dense_outputs) for j in xrange(2)]
 
-        dense_outputs = [tf.reshape(x, [args.batch_size, -1, args.rel_emb_dim]) for x in dense_outputs]
+        dense_outputs = [tf.reshape(x, [batch_size, -1, args.rel_emb_dim]) for x in dense_outputs]
 
         self.combined_head = dense_outputs[0]
         self.combined_dep  = dense_outputs[1]
@@ -158,11 +161,11 @@ class Parser:
         # transition system
         log.debug('Building computational graph for the transition system...')
         if self.train:
-            self.trans_feat_ids = tf.placeholder(tf.int32, [args.batch_size, trans_length] + feat_shape)
+            self.trans_feat_ids = tf.placeholder(tf.int32, [None, trans_length] + feat_shape)
             
-            self.trans_feat_sizes = tf.placeholder(tf.int32, [args.batch_size, trans_length])
-            self.trans_labels = tf.placeholder(tf.int32, [args.batch_size, trans_length])
-            self.trans_lengths = tf.placeholder(tf.int32, [args.batch_size])
+            self.trans_feat_sizes = tf.placeholder(tf.int32, [None, trans_length])
+            self.trans_labels = tf.placeholder(tf.int32, [None, trans_length])
+            self.trans_lengths = tf.placeholder(tf.int32, [None])
         else:
             self.trans_feat_ids = tf.placeholder(tf.int32, [None] + feat_shape)
             self.trans_feat_sizes = tf.placeholder(tf.int32, [None])
@@ -176,7 +179,7 @@ class Parser:
             transition_dense = MergeLayer(args.rel_emb_dim, args.rel_emb_dim, 1, nl=lambda x:x, combination=args.combination)
             self.transition_logit = transition_dense(tf.reshape(self.combined_head, [-1, args.rel_emb_dim]),
                     tf.reshape(self.combined_dep, [-1, args.rel_emb_dim]))
-            self.transition_logit = tf.reshape(self.transition_logit, (args.batch_size, -1))
+            self.transition_logit = tf.reshape(self.transition_logit, (batch_size, -1))
         elif args.transsys in ['AER', 'AES', 'Cov']:
             self.rel_dense = DenseLayer(args.rel_emb_dim * 4, 2 + 2 * len(mappings['rel']), nl=lambda x:x)
         elif args.transsys in ['ASd', 'AH']:
@@ -201,7 +204,17 @@ class Parser:
 
                 return loss
 
-            losses = tf.map_fn(_ex_loss, tf.range(args.batch_size), dtype=tf.float32, parallel_iterations=100)
+            if args.flat_loss:
+                # all transition steps of the batch at once
+                if args.transsys in ['NCov', 'Cov2', 'Cov3']:
+                    step_losses, step_examples = self.NCov_flat_transition_loss(SHIFT, len(mappings['rel']))
+                else:
+                    step_losses, step_examples = self.traditional_flat_transition_loss()
+                losses = tf.unsorted_segment_sum(step_losses, step_examples, batch_size)
+                if not args.no_pos:
+                    losses = tf.add(pos_losses, losses)
+            else:
+                losses = tf.map_fn(_ex_loss, tf.range(batch_size), dtype=tf.float32, parallel_iterations=100)
 
             self._loss = tf.reduce_mean(losses)
         else:
@@ -211,6 +224,8 @@ class Parser:
                 self.trans_logit_placeholder = tf.placeholder(tf.float32, (None, self.sent_length))
                 trans_pred = lambda i, k: self.NCov_transition_loss_pred(i, k, self.combined_head_placeholder[i], self.combined_dep_placeholder[i], self.trans_logit_placeholder[i], SHIFT)
                 self.pred_output_size = self.sent_length * len(mappings['rel']) + 1
+                if args.transsys == 'NCov' and args.window > 0:
+                    self.pred_output_size = 2 * args.window * len(mappings['rel']) + 1
             
             elif args.transsys == 'Cov2':
                 self.trans_logit_placeholder = tf.placeholder(tf.float32, (None, self.sent_length))
@@ -258,6 +273,87 @@ class Parser:
 
             return arc_pred
 
+    def flat_steps(self):
+        """ Returns the example and step indices of every transition step in the batch """
+        steps = tf.where(tf.sequence_mask(self.trans_lengths, tf.shape(self.trans_labels)[1]))
+        return tf.cast(steps, tf.int32)
+
+    def traditional_flat_transition_loss(self):
+        """
+        Loss of every transition step of the batch, as
+        traditional_transition_loss_pred computes it one step at a time,
+        along with the example of every step
+        """
+        steps = self.flat_steps()
+        examples = steps[:, 0]
+        feat_ids = tf.gather_nd(self.trans_feat_ids, steps)[:, :4]
+        labels = tf.gather_nd(self.trans_labels, steps)
+
+        # missing features (-1) are read from word 0 and masked out
+        word_ids = tf.stack([tf.tile(tf.expand_dims(examples, 1), [1, 4]), tf.maximum(feat_ids, 0)], 2)
+        mask = tf.expand_dims(tf.cast(tf.greater_equal(feat_ids, 0), tf.float32), 2)
+        rel_head = tf.reshape(tf.multiply(mask, tf.gather_nd(self.combined_head, word_ids)), [-1, self.args.rel_emb_dim])
+        rel_dep  = tf.reshape(tf.multiply(mask, tf.gather_nd(self.combined_dep,  word_ids)), [-1, self.args.rel_emb_dim])
+
+        rel_hid = self.rel_merge(rel_head, rel_dep)
+        rel_logit = self.rel_dense(tf.reshape(rel_hid, [-1, 4 * self.args.rel_emb_dim]))
+
+        gold_logit = tf.gather_nd(rel_logit, tf.stack([tf.range(tf.shape(labels)[0]), labels], 1))
+        return tf.reduce_logsumexp(rel_logit, 1) - gold_logit, examples
+
+    def NCov_flat_transition_loss(self, SHIFT, NUM_REL):
+        """
+        Loss of every transition step of the batch, as
+        NCov_transition_loss_pred computes it one step at a time, along with
+        the example of every step. The arc candidates of all steps are
+        scored together, and normalised over their step with segment sums.
+        """
+        steps = self.flat_steps()
+        num_steps = tf.shape(steps)[0]
+        examples = steps[:, 0]
+        feat_ids = tf.gather_nd(self.trans_feat_ids, steps)
+        feat_sizes = tf.gather_nd(self.trans_feat_sizes, steps)
+        labels = tf.gather_nd(self.trans_labels, steps)
+
+        has_shift = tf.cast(tf.equal(feat_ids[:, 0, 0], SHIFT), tf.int32)
+        shift = tf.greater(has_shift, 0)
+
+        # arc candidates of all steps, those of every step next to each other
+        slots = tf.expand_dims(tf.range(tf.shape(feat_ids)[1]), 0)
+        arcs = tf.cast(tf.where(tf.logical_and(tf.greater_equal(slots, tf.expand_dims(has_shift, 1)),
+                                               tf.less(slots, tf.expand_dims(feat_sizes, 1)))), tf.int32)
+        arc_steps = arcs[:, 0]
+        arc_feat_ids = tf.gather_nd(feat_ids, arcs)
+        arc_examples = tf.gather(examples, arc_steps)
+
+        rel_head = tf.gather_nd(self.combined_head, tf.stack([arc_examples, arc_feat_ids[:, 1]], 1))
+        rel_dep  = tf.gather_nd(self.combined_dep,  tf.stack([arc_examples, arc_feat_ids[:, 2]], 1))
+
+        rel_hid = self.rel_merge(rel_head, rel_dep)
+        rel_logit = self.rel_dense(rel_hid)
+
+        shift_words = tf.where(shift, feat_ids[:, 0, 3], tf.zeros_like(examples))
+        shift_logit = tf.gather_nd(self.transition_logit, tf.stack([examples, shift_words], 1))
+
+        # log partition function of every step
+        mx = tf.unsorted_segment_max(tf.reduce_max(rel_logit, 1), arc_steps, num_steps)
+        mx = tf.stop_gradient(tf.where(shift, tf.maximum(mx, shift_logit), mx))
+        partition = tf.unsorted_segment_sum(tf.reduce_sum(tf.exp(rel_logit - tf.expand_dims(tf.gather(mx, arc_steps), 1)), 1), arc_steps, num_steps)
+        partition = tf.add(partition, tf.where(shift, tf.exp(shift_logit - mx), tf.zeros_like(mx)))
+        log_partition = tf.log(partition) + mx
+
+        # the gold arc of a step is in row label (less one with Shift) of
+        # its flattened arc logits; steps whose gold transition is Shift
+        # point at a row of zeros past the arcs instead
+        gold_shift = tf.logical_and(shift, tf.equal(labels, 0))
+        arc_label = tf.where(gold_shift, tf.zeros_like(labels), labels - has_shift)
+        arc_starts = tf.cumsum(feat_sizes - has_shift, exclusive=True)
+        gold_rows = tf.where(gold_shift, tf.fill([num_steps], tf.shape(rel_logit)[0]), arc_starts + arc_label // NUM_REL)
+        rel_logit = tf.concat([rel_logit, tf.zeros([1, NUM_REL])], 0)
+        gold_logit = tf.where(gold_shift, shift_logit, tf.gather_nd(rel_logit, tf.stack([gold_rows, arc_label % NUM_REL], 1)))
+
+        return log_partition - gold_logit, examples
+
     def NCov_transition_loss_pred(self, i, j, combined_head, combined_dep, transition_logit, SHIFT):
         # extract relevant portions of params
         rel_trans_feat_ids = self.trans_feat_ids[i*self.args.beam_size+j] if not self.train else self.trans_feat_ids[i, j]
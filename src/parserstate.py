@@ -2,46 +2,122 @@
 Parser state of transition-based parsers.
 """
 
-from copy import copy
+from array import array
+
+class ParserState(object):
+    # beam search clones states at every step, so keep them compact: no
+    # per-instance dict, and flat int32 buffers that clone with a memcpy
+    __slots__ = ['top', 'front', 'length', 'head', 'rel', 'link', 'pos', 'goldrels', 'goldindex', 'transsys', '_transitionset']
 
-class ParserState:
     def __init__(self, sentence, transsys=None, goldrels=None):
-        self.list1 = [0]
-        self.list2 = []
+        # list1 followed by list2 always holds the tokens read so far in
+        # sentence order, so both lists and the buffer are ranges of token
+        # indices: list1 is [0, top), list2 is [top, front) and the buffer
+        # is [front, length)
+        self.top = 1
         # sentences should already have a <ROOT> symbol as the first token
-        self.buf = [i+1 for i in xrange(len(sentence)-1)]
+        self.front = 1
+        self.length = len(sentence)
         # head and relation labels
-        self.head = [[-1, -1] for _ in xrange(len(sentence))]
+        self.head = array('i', [-1]) * len(sentence)
+        self.rel = array('i', [-1]) * len(sentence)
+        # union-find links over the partial trees built so far, used to
+        # answer cycle checks without walking head chains
+        self.link = array('i', xrange(len(sentence)))
 
-        self.pos = [-1 for _ in xrange(len(sentence))]
+        self.pos = array('i', [-1]) * len(sentence)
 
         self.goldrels = goldrels
+        # gold arc lookups built lazily by the oracle
+        self.goldindex = None
 
         self.transsys = transsys
         if self.transsys is not None:
             self.transsys._preparetransitionset(self)
 
     def show_head(self):
-        a=self.head[1:len(self.head)]
+        a=zip(self.head[1:], self.rel[1:])
         print a
         for x,y in a:
             if x == -1:
                print a 
         
-        
-    
+    @property
+    def list1(self):
+        return range(self.top)
+
+    @property
+    def list2(self):
+        return range(self.top, self.front)
+
+    @property
+    def buf(self):
+        return range(self.front, self.length)
+
+    def tree_root(self, n):
+        """ Returns the root of the partial tree that contains n """
+        link = self.link
+        r = n
+        while link[r] != r:
+            r = link[r]
+        # path compression
+        while link[n] != r:
+            link[n], n = r, link[n]
+        return r
+
+    def add_arc(self, h, d, rel):
+        """ Attaches d (which must not have a head yet) to h """
+        self.head[d] = h
+        self.rel[d] = rel
+        self.link[d] = self.tree_root(h)
+        return h, d, rel
+
     def transitionset(self):
         return self._transitionset
 
     def clone(self):
-        res = ParserState([])
-        res.list1 = copy(self.list1)
-        res.list2 = copy(self.list2)
-        res.buf = copy(self.buf)
-        res.head = copy(self.head)
-        res.pos = copy(self.pos)
-        res.goldrels = copy(self.goldrels)
+        res = ParserState.__new__(ParserState)
+        res.top = self.top
+        res.front = self.front
+        res.length = self.length
+        res.head = self.head[:]
+        res.rel = self.rel[:]
+        res.link = self.link[:]
+        # positions are never written during parsing, and the gold arcs and
+        # transition sets are replaced rather than updated in place, so
+        # these can be shared with the original
+        res.pos = self.pos
+        res.goldrels = self.goldrels
+        res.goldindex = self.goldindex
         res.transsys = self.transsys
         if hasattr(self, '_transitionset'):
-            res._transitionset = copy(self._transitionset)
+            res._transitionset = self._transitionset
         return res
+
+class BeamNode(object):
+    """
+    A hypothesis in the beam search lattice. Instead of a full parser state
+    it keeps its score, a backpointer to the hypothesis it was expanded
+    from, the transition taken and the arc (head, dependent, relation) that
+    transition built, if any.
+    """
+    __slots__ = ['score', 'parent', 'action', 'arc']
+
+    def __init__(self, score, parent=None, action=None, arc=None):
+        self.score = score
+        self.parent = parent
+        self.action = action
+        self.arc = arc
+
+    def heads(self, length):
+        """ Rebuilds heads and relation labels by following backpointers """
+        head = [-1] * length
+        rel = [-1] * length
+        node = self
+        while node is not None:
+            if node.arc is not None:
+                h, d, r = node.arc
+                head[d] = h
+                rel[d] = r
+            node = node.parent
+        return head, rel
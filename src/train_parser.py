@@ -5,6 +5,7 @@ import cPickle as pickle
 from smart_open import smart_open
 import logging
 import sys
+import time
 import os.path as op
 import numpy as np
 from utils import *
@@ -12,8 +13,10 @@ import random
 from transition import Covington, NewCovington, Covington2, Covington3
 
 from parser import Parser
+from cache import ArtifactCache, input_key
+from dataset import ShardedDataset
 from init_argparse import init_argparse
-from itertools import izip
+from itertools import izip, islice, imap
 from heapq import nlargest, heappush, heappushpop, nsmallest
 
 import socket
@@ -26,14 +29,105 @@ log = logging.getLogger(__name__)
 def train(args):
     transsys = transsys_lookup(args.transsys)
 
-    vocab, vecs, pretrained = read_vocab(conll_file=args.conll_file, wordvec_file=args.wordvec_file, vocab_file=args.vocab_file, wordvec_dim=args.wordvec_dim, min_count=args.min_count, log=log)
+    # saved vocabularies and features are only reused if they were built
+    # from the same inputs
+    cache = ArtifactCache(args.cache_dir, args.cache_size * 1048576, log=log) if args.cache_dir is not None else None
+    wordvec_corpora = [f for f in args.wordvec_corpora.split(',') if f] if args.filter_wordvecs else None
+    # binary word vectors come with their word list in a file of its own
+    wordvec_files = [args.wordvec_file] + ([wordvec_index_file(args.wordvec_file)] if args.wordvec_file is not None and args.wordvec_file.endswith('.npy') else [])
+    vocab_key = input_key([args.conll_file] + wordvec_files + (wordvec_corpora or []), 'vocab', args.wordvec_dim, args.min_count, args.filter_wordvecs)
+    feats_key = input_key([args.conll_file, args.seq_file, args.mappings_file], 'feats', args.transsys, args.fpos, args.window)
+
+    try:
+        vocab, vecs, pretrained = read_vocab(conll_file=args.conll_file, wordvec_file=args.wordvec_file, vocab_file=args.vocab_file, wordvec_dim=args.wordvec_dim, min_count=args.min_count, log=log, cache=cache, key=vocab_key, wordvec_corpora=wordvec_corpora, load_unkeyed=args.load_unkeyed)
+    except ValueError as e:
+        log.error(str(e))
+        sys.exit(1)
     mappings, invmappings = read_mappings(args.mappings_file, transsys, log=log)
-    data, sent_length, trans_length = read_data(conll_file=args.conll_file, seq_file=args.seq_file, vocab=vocab, mappings=mappings, transsys=transsys, fpos=args.fpos, log=log)
-    feats, feat_dim = featurize_transitions(data, mappings, invmappings, args.feat_file, transsys, log=log)
 
-    feat_shape = [5] if args.transsys == 'Cov' else [feat_dim, 5]
+    # examples and batches are shuffled with a generator of their own, so
+    # that estimating the batches in an epoch leaves the global one alone,
+    # and the thread that assembles batches ahead does not share it
+    rng = random.Random(random.getrandbits(32))
+
+    if args.dataset_dir is not None:
+        # stream the examples through a sharded dataset instead of holding
+        # them all in memory
+        dataset_key = input_key([], vocab_key, feats_key)
+        if ShardedDataset.exists(args.dataset_dir, dataset_key):
+            dataset = ShardedDataset(args.dataset_dir)
+            log.info('Read %d examples in %d shards from dataset "%s".' % (len(dataset), len(dataset.shards), args.dataset_dir))
+        else:
+            examples = iter_data(conll_file=args.conll_file, seq_file=args.seq_file, vocab=vocab, mappings=mappings, transsys=transsys, fpos=args.fpos, log=log)
+            goldf = None
+            if args.seq_file is not None:
+                featurize = lambda data: featurize_examples(data, mappings, invmappings, transsys, window=args.window, workers=args.feat_workers, log=log)
+            else:
+                # run the oracle on the gold trees of each shard as it is
+                # written
+                goldf = smart_open(args.conll_file, 'r')
+                gold = iter_blocks(goldf)
+                featurize = lambda data: featurize_examples(list(islice(gold, len(data))), mappings, invmappings, transsys, window=args.window, workers=args.feat_workers, log=log, gold=True)
+            try:
+                dataset = ShardedDataset.build(args.dataset_dir, examples, featurize, shard_size=args.shard_size, fpos=args.fpos, key=dataset_key, log=log)
+            except ValueError as e:
+                log.error(str(e))
+                sys.exit(1)
+            finally:
+                if goldf is not None:
+                    goldf.close()
+        num_examples = len(dataset)
+        sent_length, trans_length, feat_dim = dataset.max_sent_len, dataset.max_trans_len, dataset.max_feat_size
+
+        def epoch_examples():
+            return dataset.iter_examples(args.shuffle_pool, rng)
+    else:
+        data, sent_length, trans_length = read_data(conll_file=args.conll_file, seq_file=args.seq_file, vocab=vocab, mappings=mappings, transsys=transsys, fpos=args.fpos, log=log)
+        # without oracle sequences the transitions come from the gold trees
+        gold_file = args.conll_file if args.seq_file is None else None
+        try:
+            feats, feat_dim = featurize_transitions(data, mappings, invmappings, args.feat_file, transsys, log=log, window=args.window, feat_format=args.feat_format, workers=args.feat_workers, cache=cache, key=feats_key, gold_file=gold_file, load_unkeyed=args.load_unkeyed)
+        except ValueError as e:
+            log.error(str(e))
+            sys.exit(1)
+        if gold_file is not None:
+            trans_length = feats.max_steps
+        num_examples = len(data)
+        data = [example_arrays(t) for t in data]
+
+        indices = range(len(data))
+        def epoch_examples():
+            rng.shuffle(indices)
+            return ((data[i], feats[i]) for i in indices)
+
+    log.info('Longest sentence %d, longest transition sequence %d, largest feature size %d; batches are padded to their own longest example.' % (sent_length, trans_length, feat_dim))
+
+    if args.budget_unit == 'tokens':
+        dims = lambda t: (len(t[0][0]),)
+    else:
+        # transition steps by candidate transitions per step
+        dims = lambda t: (len(t[1][3]), 1 if args.transsys == 'Cov' else t[1][2].max())
+    make_batches = lambda examples: iter_batches(examples, args.batch_size, args.buckets, rng, budget=args.batch_budget, dims=dims)
+
+    if args.batch_budget > 0:
+        # batches vary in size, so the learning rate schedule needs an
+        # estimate of the batches in a pass over the data, made from the
+        # sentence length, transition steps and candidate transitions of the
+        # examples alone, which are padded and sorted the same way
+        single = args.transsys == 'Cov'
+        if args.dataset_dir is not None:
+            shapes = dataset.example_dims(single)
+        else:
+            shapes = np.column_stack([[len(t[0]) for t in data], feats.example_dims(single)])
+        shape_dims = (lambda s: s[:1]) if args.budget_unit == 'tokens' else (lambda s: s[1:])
+        steps_per_epoch = count_batches(shapes, args.batch_size, args.buckets, args.batch_budget, dims=shape_dims, key=lambda s: (s[0], s[1]), rng=rng)
+        log.info('Packing batches up to %d %s, about %d batches per epoch.' % (args.batch_budget, args.budget_unit, steps_per_epoch))
+    else:
+        steps_per_epoch = num_examples / args.batch_size
 
-    parser = Parser(args, vecs, pretrained, mappings, invmappings, sent_length, trans_length, feat_dim, log)
+    # time dimensions are left open so that every batch can be padded to its
+    # own longest example
+    parser = Parser(args, vecs, pretrained, mappings, invmappings, None, None, None, log)
     loss = parser.loss
 
     log.info('Computational graph successfully built.')
@@ -43,7 +137,7 @@ def train(args):
 
     global_step = tf.Variable(0, trainable=False)
     if args.anneal >= 0:
-        boundaries = [int(len(data) / args.batch_size * i * args.epoch_multiplier) for i in xrange(args.anneal, args.epochs)]
+        boundaries = [int(steps_per_epoch * i * args.epoch_multiplier) for i in xrange(args.anneal, args.epochs)]
         values = [args.lr] + [args.lr * (2 ** (args.anneal - i - 1)) for i in xrange(args.anneal, args.epochs)]
         learning_rate = tf.train.piecewise_constant(global_step, boundaries, values)
     else:
@@ -63,6 +157,57 @@ def train(args):
 
     UNKID = vocab['<UNK>']
 
+    def feed_batch(batch_examples):
+        """ Assembles the feed dict of a batch, along with its sentence and transition lengths """
+        batch_data = [t[0] for t in batch_examples]
+        # views into the feature store
+        batch_feats = [t[1] for t in batch_examples]
+        batch_size = len(batch_examples)
+
+        # prepare data in tensor shape, padded to the longest
+        # example of the batch
+        batch_sent_lengths = np.array([len(datum[0]) for datum in batch_data], dtype=np.int32)
+        batch_words = pad_sequences([datum[0] for datum in batch_data], batch_sent_lengths)
+        batch_words2 = batch_words.copy()
+        batch_gold_pos = pad_sequences([datum[2] for datum in batch_data], batch_sent_lengths)
+        if args.fpos:
+            batch_gold_fpos = pad_sequences([datum[3] for datum in batch_data], batch_sent_lengths)
+
+        if args.word_dropout > 0:
+            mask = np.random.rand(*batch_words.shape) <= args.word_dropout
+            batch_words[mask] = UNKID
+
+        batch_trans_lengths = np.array([len(feat[3]) for feat in batch_feats], dtype=np.int32)
+        batch_trans_feat_sizes = pad_sequences([feat[2] for feat in batch_feats], batch_trans_lengths)
+        batch_trans_labels = pad_sequences([feat[3] for feat in batch_feats], batch_trans_lengths)
+        # every step has at least one candidate
+        assert (batch_trans_feat_sizes > 0).sum() == batch_trans_lengths.sum()
+
+        # scatter the feature rows of every example into their steps and,
+        # but for Covington, their slots among the candidates of the step
+        row_counts = [len(feat[0]) for feat in batch_feats]
+        rows = np.concatenate([feat[0] for feat in batch_feats])
+        row_examples = np.repeat(np.arange(batch_size), row_counts)
+        row_steps = np.concatenate([feat[4] for feat in batch_feats])
+        if args.transsys == 'Cov':
+            batch_trans_feat_ids = np.zeros((batch_size, batch_trans_lengths.max(), 5), dtype=np.int32)
+            batch_trans_feat_ids[row_examples, row_steps] = rows
+        else:
+            batch_trans_feat_ids = np.zeros((batch_size, batch_trans_lengths.max(), batch_trans_feat_sizes.max(), 5), dtype=np.int32)
+            batch_trans_feat_ids[row_examples, row_steps, np.concatenate([feat[5] for feat in batch_feats])] = rows
+
+        feed_dict={parser.words: batch_words,
+                   parser.words2: batch_words2,
+                   parser.sent_lengths: batch_sent_lengths,
+                   parser.trans_feat_ids: batch_trans_feat_ids,
+                   parser.trans_feat_sizes: batch_trans_feat_sizes,
+                   parser.trans_labels: batch_trans_labels,
+                   parser.trans_lengths: batch_trans_lengths,
+                   parser.gold_pos: batch_gold_pos}
+        if args.fpos:
+            feed_dict[parser.gold_fpos] = batch_gold_fpos
+        return feed_dict, batch_sent_lengths, batch_trans_lengths
+
     log.info('Starting tensorflow session...')
     # Avoid taking up all of the memory on the GPU
     config = tf.ConfigProto()
@@ -81,84 +226,24 @@ def train(args):
             log.info('Previously trained model recovered from "%s"' % (filename))
             epoch0 = epoch
             loaded = True
-            sess.run(global_step.assign(len(data) / args.batch_size * (epoch0 + 1)))
+            sess.run(global_step.assign(steps_per_epoch * (epoch0 + 1)))
             break
 
-        indices = range(len(data))
         for epoch in xrange(epoch0+1, int(epochs * args.epoch_multiplier)):
-            random.shuffle(indices)
-            for batch in xrange(len(data) / args.batch_size):
-                idx = indices[batch * args.batch_size:(batch+1) * args.batch_size]
-
-                batch_data = [data[i] for i in idx]
-                batch_feats = [feats[i] for i in idx]
-
-                # prepare data in tensor shape
-                batch_sent_lengths = np.array([len(datum[0]) for datum in batch_data], dtype=np.int32)
-                batch_words = np.zeros((args.batch_size, sent_length), dtype=np.int32)
-                batch_words2 = np.zeros((args.batch_size, sent_length), dtype=np.int32)
-                batch_gold_pos = np.zeros((args.batch_size, sent_length), dtype=np.int32)
-                if args.fpos:
-                    batch_gold_fpos = np.zeros((args.batch_size, sent_length), dtype=np.int32)
-                for i in xrange(args.batch_size):
-                    batch_words[i, :batch_sent_lengths[i]] = batch_data[i][0]
-                    batch_words2[i, :batch_sent_lengths[i]] = batch_data[i][0]
-                    batch_gold_pos[i, :batch_sent_lengths[i]] = batch_data[i][2]
-                    if args.fpos:
-                        batch_gold_fpos[i, :batch_sent_lengths[i]] = batch_data[i][3]
-
-                if args.word_dropout > 0:
-                    mask = np.random.rand(*batch_words.shape) <= args.word_dropout
-                    batch_words[mask] = UNKID
-
-                batch_trans_feat_ids = np.zeros(tuple([args.batch_size, trans_length] + feat_shape), dtype=np.int32)
-                batch_trans_feat_sizes = np.zeros((args.batch_size, trans_length), dtype=np.int32)
-                batch_trans_labels = np.zeros((args.batch_size, trans_length), dtype=np.int32)
-                batch_trans_lengths = np.array([len(feat[0]) for feat in batch_feats], dtype=np.int32)
-
-                if args.transsys == 'NCov' or args.transsys == 'Cov3' :
-                    for i in xrange(args.batch_size):
-                        for j in xrange(batch_trans_lengths[i]):
-                            batch_trans_feat_ids[i, j, :len(batch_feats[i][0][j]), :] = batch_feats[i][0][j][:len(batch_feats[i][0][j])]
-                            batch_trans_feat_sizes[i, j] = batch_feats[i][1][j]
-                            assert(batch_feats[i][1][j] > 0)
-                            batch_trans_labels[i, j] = batch_feats[i][2][j]
-                
-                
-                elif  args.transsys == 'Cov2':
-                    for i in xrange(args.batch_size):
-                        for j in xrange(batch_trans_lengths[i]):
-                            
-                            batch_trans_feat_ids[i, j, :len(batch_feats[i][0][j]), :] = batch_feats[i][0][j][:len(batch_feats[i][0][j])]
-                            batch_trans_feat_sizes[i, j] = batch_feats[i][1][j]
-                            assert(batch_feats[i][1][j] > 0)
-                            batch_trans_labels[i, j] = batch_feats[i][2][j]
-                
-                
-                
-                else:
-                    for i in xrange(args.batch_size):
-                        for j in xrange(batch_trans_lengths[i]):
-                            batch_trans_feat_ids[i, j, :] = batch_feats[i][0][j]
-                            batch_trans_feat_sizes[i, j] = batch_feats[i][1][j]
-                            assert(batch_feats[i][1][j] > 0)
-                            batch_trans_labels[i, j] = batch_feats[i][2][j]
-
-                
-                # perform update
-                feed_dict={parser.words: batch_words,
-                           parser.words2: batch_words2,
-                           parser.sent_lengths: batch_sent_lengths,
-                           parser.trans_feat_ids: batch_trans_feat_ids,
-                           parser.trans_feat_sizes: batch_trans_feat_sizes,
-                           parser.trans_labels: batch_trans_labels,
-                           parser.trans_lengths: batch_trans_lengths,
-                           parser.gold_pos: batch_gold_pos}
-                if args.fpos:
-                    feed_dict[parser.gold_fpos] = batch_gold_fpos
-                _, l = sess.run([opt_op, loss], feed_dict=feed_dict)
-
-                log.info('Epoch %3d batch %4d Loss: %8f (per transition: %8f)' % (epoch, batch, l, (l * args.batch_size / np.sum(batch_trans_lengths))))
+            epoch_start = time.time()
+            epoch_tokens = 0
+            batches = Prefetcher(imap(feed_batch, make_batches(epoch_examples())), args.prefetch)
+            try:
+                for batch, (feed_dict, batch_sent_lengths, batch_trans_lengths) in enumerate(batches):
+                    epoch_tokens += np.sum(batch_sent_lengths - 1)
+                    _, l = sess.run([opt_op, loss], feed_dict=feed_dict)
+
+                    log.info('Epoch %3d batch %4d Loss: %8f (per transition: %8f)' % (epoch, batch, l, (l * len(batch_trans_lengths) / np.sum(batch_trans_lengths))))
+            finally:
+                batches.close()
+
+            elapsed = time.time() - epoch_start
+            log.info('Epoch %3d: %d tokens in %.1fs (%.1f tokens/s), %.1fs (%.1f%%) spent waiting for batches' % (epoch, epoch_tokens, elapsed, epoch_tokens / max(elapsed, 1e-6), batches.wait, 100 * batches.wait / max(elapsed, 1e-6)))
 
             if epoch+1 == int(epochs * args.epoch_multiplier):#Updated to only save the last model
                 saver.save(sess, savefilename % (args.model_dir, epoch))
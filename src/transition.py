@@ -1,6 +1,8 @@
 import random
 from tarjan import tarjan
 import sys
+import numpy as np
+from bisect import bisect_left
 
 
 """
@@ -12,26 +14,106 @@ explicitly itself.
 """
 
 class TransitionSystem(object):
-    def __init__(self, mappings, invmappings,epoch=1):
+    def __init__(self, mappings, invmappings,epoch=1, window=0):
         self.mappings, self.invmappings = mappings, invmappings
         self.epoch=epoch
+        # how far into list1 arc transitions may reach, 0 for no limit
+        # (only used by NewCovington)
+        self.window=window
         random.seed(epoch)
 
     def _preparetransitionset(self, parserstate):
         """ Prepares the set of gold transitions given a parser state """
         raise NotImplementedError()
 
+    def create_cycles(self, parserstate, h, d):
+        """
+        Checks whether making d an ancestor of h closes a cycle.
+
+        Callers only ask this for a d that has no head yet, i.e. the root of
+        its partial tree, so it amounts to comparing d with the root of h.
+        """
+        if h == d:
+            return True
+        if h < 0:
+            return False
+        return parserstate.tree_root(h) == d
+
     def advance(self, parserstate, action):
-        """ Advances a parser state given an action """
+        """
+        Advances a parser state given an action, and returns the arc
+        (head, dependent, relation) built by it, if any
+        """
         raise NotImplementedError()
 
     def goldtransition(self, parserstate, goldrels):
         """ Returns the next gold transition given the set of gold arcs """
         raise NotImplementedError()
 
+    def _goldindex(self, parserstate, goldrels):
+        """
+        Returns (goldrels, gold head of every token, leftmost gold dependent
+        of every token, sorted gold neighbours to the left of every token),
+        so that oracles can answer questions about list1 without scanning
+        it. The index is built once per sentence and kept on the state.
+        """
+        index = parserstate.goldindex
+        if index is None or index[0] is not goldrels:
+            n = len(goldrels)
+            goldhead = [-1] * n
+            leftmost = [n] * n
+            left = [[] for _ in xrange(n)]
+            for h, deps in enumerate(goldrels):
+                for d in deps:
+                    goldhead[d] = h
+                    leftmost[h] = min(leftmost[h], d)
+                    if d < h:
+                        left[h].append(d)
+                    else:
+                        left[d].append(h)
+            for x in left:
+                x.sort()
+            index = (goldrels, goldhead, leftmost, left)
+            parserstate.goldindex = index
+        return index
+
+    def transition_mask(self, parserstate, size):
+        """
+        Returns an int8 mask over a model output vector of the given size,
+        set at the indices of the transitions allowed in the parser state.
+
+        This covers the layouts where outputs follow the order of the
+        transition set: a single slot for Shift if it comes first, then one
+        slot per relation label for every other candidate.
+        """
+        mask = np.zeros(size, dtype=np.int8)
+        cand = parserstate.transitionset()
+        if len(cand) > 0:
+            SHIFT = self.mappings['action']['Shift']
+            RELS = len(self.mappings['rel'])
+            if cand[0][0] == SHIFT:
+                mask[:1 + (len(cand) - 1) * RELS] = 1
+            else:
+                mask[:len(cand) * RELS] = 1
+        return mask
+
+    def transition_masks(self, parserstates, size):
+        """ Returns the transition masks of a batch of parser states, one per row """
+        masks = np.zeros((len(parserstates), size), dtype=np.int8)
+        for i, parserstate in enumerate(parserstates):
+            masks[i] = self.transition_mask(parserstate, size)
+        return masks
+
     def trans_to_str(self, transition, state, pos, fpos=None):
         raise NotImplementedError()
 
+    def trans_to_fields(self, transition, state, pos, fpos=None):
+        """
+        Returns the fields trans_from_line would read back from
+        trans_to_str, with the action and relation already as integers
+        """
+        raise NotImplementedError()
+
     @classmethod
     def trans_from_line(self, line):
         raise NotImplementedError()
@@ -47,40 +129,27 @@ class Covington(TransitionSystem):
     def actions_list(self):
         return [ 'NoArc', 'Shift', 'Left-Arc', 'Right-Arc']
 
-    def create_cycles(self, parserstate, h, d):
-        head = parserstate.head
-        n = h
-        
-        if n == d:
-            return True 
-        
-        while n > 0:
-            n = head[n][0]
-            if n == d:
-                return True 
-        return False
-
     def _preparetransitionset(self, parserstate):
         NOARC = self.mappings['action']['NoArc']
         SHIFT = self.mappings['action']['Shift']
         LEFTARC = self.mappings['action']['Left-Arc']
         RIGHTARC = self.mappings['action']['Right-Arc']
         
-        list1, list2, buf, head = parserstate.list1, parserstate.list2, parserstate.buf, parserstate.head
+        top, front, head = parserstate.top, parserstate.front, parserstate.head
 
         t = []
         
-        if len(buf) != 0:
+        if front < parserstate.length:
             
-            if len(list1) == 0:
+            if top == 0:
                 t += [(SHIFT, -1)]
             else:  
                 t += [(NOARC, -1)]
                 t += [(SHIFT, -1)]
-                if list1[len(list1)-1] != 0 and head[list1[len(list1)-1]][0] < 0 and not self.create_cycles(parserstate, head[buf[0]][0], list1[len(list1)-1]):
+                if top-1 != 0 and head[top-1] < 0 and not self.create_cycles(parserstate, head[front], top-1):
                     t += [(LEFTARC,)]
             
-                if head[buf[0]][0] < 0 and not self.create_cycles(parserstate, head[list1[len(list1)-1]][0], buf[0]):
+                if head[front] < 0 and not self.create_cycles(parserstate, head[top-1], front):
                     t += [(RIGHTARC,)]
                 
         parserstate._transitionset = t
@@ -105,31 +174,28 @@ class Covington(TransitionSystem):
            rel = action[-1]
            a = action[:-1]
 
-        list1 = parserstate.list1
-        list2 = parserstate.list2
-        buf = parserstate.buf
+        top = parserstate.top
+        front = parserstate.front
         
+        arc = None
         if a[0] == LEFTARC:
-            n = len(list1)-1 
-            parserstate.head[list1[n]] = [buf[0], rel]
-            parserstate.list2 = [list1[n]]+list2
-            parserstate.list1 = list1[:n]
+            n = top-1 
+            arc = parserstate.add_arc(front, n, rel)
+            parserstate.top = n
         elif a[0] == RIGHTARC:
-            n = len(list1)-1 
-            parserstate.head[buf[0]] = [list1[n], rel]
-            parserstate.list2 = [list1[n]]+list2
-            parserstate.list1 = list1[:n]
+            n = top-1 
+            arc = parserstate.add_arc(n, front, rel)
+            parserstate.top = n
         
         elif a[0] == SHIFT:
-            parserstate.list1 = list1+list2+[buf[0]]
-            parserstate.list2 = [];
-            parserstate.buf = buf[1:]
+            parserstate.top = front+1
+            parserstate.front = front+1
         else:
-            n = len(list1)-1
-            parserstate.list2 = [list1[n]]+list2
-            parserstate.list1 = list1[:n]
+            n = top-1
+            parserstate.top = n
             
         self._preparetransitionset(parserstate)
+        return arc
 
     def goldtransition(self, parserstate, goldrels=None):
         NOARC = self.mappings['action']['NoArc']
@@ -139,34 +205,23 @@ class Covington(TransitionSystem):
         
 
         goldrels = goldrels or parserstate.goldrels
-        list1 = parserstate.list1
-        list2 = parserstate.list2
-        buf = parserstate.buf
+        top = parserstate.top
         head = parserstate.head
 
-        r = buf[0]
+        r = parserstate.front
         addedArc = False
-        noleftchildren = True
-        for x in list1:
-            if x in goldrels[r]:
-                noleftchildren = False
-                break    
-        
-        
-        norighthead = True
-        for x in list1:
-            if r in goldrels[x]:
-                norighthead = False
-                break
+        _, goldhead, leftmost, _ = self._goldindex(parserstate, goldrels)
+        noleftchildren = leftmost[r] >= top
+        norighthead = not 0 <= goldhead[r] < top
         
         
         
-        if len(list1) == 0:
+        if top == 0:
             a = (SHIFT, -1)
             return a
             
         
-        l = list1[len(list1)-1]     
+        l = top-1     
         if l in goldrels[r]:
             rel = goldrels[r][l]
             a = (LEFTARC, rel)
@@ -187,9 +242,9 @@ class Covington(TransitionSystem):
         RIGHTARC = self.mappings['action']['Right-Arc']
         if t[0] == SHIFT:
             if fpos is None:
-                return "Shift\t%s" % (pos[state.buf[0]])
+                return "Shift\t%s" % (pos[state.front])
             else:
-                return "Shift\t%s\t%s" % (pos[state.buf[0]], fpos[state.buf[0]])
+                return "Shift\t%s\t%s" % (pos[state.front], fpos[state.front])
         elif t[0] == LEFTARC:
             return "Left-Arc\t%s" % (self.invmappings['rel'][t[1]])
         elif t[0] == RIGHTARC:
@@ -197,6 +252,18 @@ class Covington(TransitionSystem):
         elif t[0] == NOARC:
             return "NoArc"
 
+    def trans_to_fields(self, t, state, pos, fpos=None):
+        NOARC = self.mappings['action']['NoArc']
+        SHIFT = self.mappings['action']['Shift']
+        if t[0] == SHIFT:
+            fields = {'action': t[0], 'pos': pos[state.front]}
+            if fpos is not None:
+                fields['fpos'] = fpos[state.front]
+            return fields
+        elif t[0] == NOARC:
+            return {'action': t[0]}
+        return {'action': t[0], 'rel': t[1]}
+
     @classmethod
     def trans_from_line(self, line):
         if line[0] == 'Left-Arc':
@@ -245,6 +312,21 @@ class Covington(TransitionSystem):
         if t[0] == RIGHTARC:
             return base + t[1]
 
+    def transition_mask(self, parserstate, size):
+        """ Outputs have a fixed layout here: NoArc, Shift, then a block of relations per arc """
+        LEFTARC = self.mappings['action']['Left-Arc']
+        RIGHTARC = self.mappings['action']['Right-Arc']
+        RELS = len(self.mappings['rel'])
+
+        mask = np.zeros(size, dtype=np.int8)
+        for t in parserstate.transitionset():
+            base = self.tuple_trans_to_int(None, (t[0], 0))
+            if t[0] == LEFTARC or t[0] == RIGHTARC:
+                mask[base:base + RELS] = 1
+            else:
+                mask[base] = 1
+        return mask
+
     def tuple_trans_from_int(self, cand, action):
         NOARC = self.mappings['action']['NoArc']
         SHIFT = self.mappings['action']['Shift']
@@ -285,55 +367,75 @@ class NewCovington(TransitionSystem):
     def actions_list(self):
         return [ 'Shift', 'Left-Arc', 'Right-Arc']
 
-    def create_cycles(self, parserstate, h, d):
-        head = parserstate.head
-        n = h
-        
-        if n == d:
-            return True 
-        
-        while n > 0:
-            n = head[n][0]
-            if n == d:
-                return True 
-        return False
-
     def _preparetransitionset(self, parserstate):
         SHIFT = self.mappings['action']['Shift']
         LEFTARC = self.mappings['action']['Left-Arc']
         RIGHTARC = self.mappings['action']['Right-Arc']
         
-        list1, list2, buf, head = parserstate.list1, parserstate.list2, parserstate.buf, parserstate.head
+        top, front, head = parserstate.top, parserstate.front, parserstate.head
+
+        span = min(top, self.window) if self.window > 0 else top
 
         t = []
-        if len(buf) != 0:
+        if front < parserstate.length:
             
         
-            if len(list1) == 0:
+            if top == 0:
                 t += [(SHIFT, -1)]
             else:  
                 t += [(SHIFT, -1)]
                 
                 
-                for si in xrange(len(list1)):
-                    n = len(list1)-1
+                for si in xrange(span):
+                    n = top-1
                     li = n - si
-                    if list1[li] != 0 and head[list1[li]][0] < 0 and not self.create_cycles(parserstate, head[buf[0]][0], list1[li]):
+                    if li != 0 and head[li] < 0 and not self.create_cycles(parserstate, head[front], li):
                         t += [(LEFTARC, si)]
                     
-                for si in xrange(len(list1)):
-                    n = len(list1)-1
+                for si in xrange(span):
+                    n = top-1
                     li = n - si
                     
-                    if head[buf[0]][0] < 0 and not self.create_cycles(parserstate, head[list1[li]][0], buf[0]):
+                    if head[front] < 0 and not self.create_cycles(parserstate, head[li], front):
                         t += [(RIGHTARC, si)]
                 
            
         
         parserstate._transitionset = t
-    
-    
-        
+
+    def _updatetransitionset(self, parserstate, action, si):
+        """
+        Updates the transition set after an arc to list1 position si.
+
+        The arc pops si+1 items off list1 and keeps the buffer, so the
+        surviving candidates keep their relative order and only need their
+        offsets shifted. A Left-Arc can only rule out Right-Arcs from the
+        partial tree of the new dependent, while a Right-Arc rules out every
+        Right-Arc and the Left-Arc to the root of the new head's tree.
+        """
+        SHIFT = self.mappings['action']['Shift']
+        LEFTARC = self.mappings['action']['Left-Arc']
+        RIGHTARC = self.mappings['action']['Right-Arc']
+
+        n = parserstate.top-1
+        front = parserstate.front
+        k = si + 1
+
+        t = [(SHIFT, -1)]
+        if action == LEFTARC:
+            for a, sj in parserstate._transitionset:
+                if sj < k:
+                    continue
+                if a == LEFTARC or (a == RIGHTARC and parserstate.tree_root(n-sj+k) != front):
+                    t += [(a, sj-k)]
+        else:
+            r = parserstate.tree_root(front)
+            for a, sj in parserstate._transitionset:
+                if a == LEFTARC and sj >= k and n-sj+k != r:
+                    t += [(a, sj-k)]
+
+        parserstate._transitionset = t
+
     def advance(self, parserstate, action):
         SHIFT = self.mappings['action']['Shift']
         LEFTARC = self.mappings['action']['Left-Arc']
@@ -352,31 +454,33 @@ class NewCovington(TransitionSystem):
            rel = action[-1]
            a = action[:-1]
 
-        list1 = parserstate.list1
-        list2 = parserstate.list2
-        buf = parserstate.buf
+        top = parserstate.top
+        front = parserstate.front
         
         
+        arc = None
         if a[0] == LEFTARC:
-            n = len(list1)-1
+            n = top-1
             si = a[1] 
-            parserstate.head[list1[n-si]] = [buf[0], rel]
-            parserstate.list2 = list1[(n-si):]+list2
-            parserstate.list1 = list1[:(n-si)]
+            arc = parserstate.add_arc(front, n-si, rel)
+            parserstate.top = n-si
         elif a[0] == RIGHTARC:
-            n = len(list1)-1
+            n = top-1
             si = a[1] 
-            parserstate.head[buf[0]] = [list1[n-si], rel]
-            parserstate.list2 = list1[(n-si):]+list2
-            parserstate.list1 = list1[:(n-si)]
+            arc = parserstate.add_arc(n-si, front, rel)
+            parserstate.top = n-si
         
         elif a[0] == SHIFT:
-            parserstate.list1 = list1+list2+[buf[0]]
-            parserstate.list2 = [];
-            parserstate.buf = buf[1:]
+            parserstate.top = front+1
+            parserstate.front = front+1
             
-       
-        self._preparetransitionset(parserstate)
+        # arcs can bring positions from outside the window into it, but
+        # then the full update is O(window) anyway
+        if a[0] == SHIFT or self.window > 0:
+            self._preparetransitionset(parserstate)
+        else:
+            self._updatetransitionset(parserstate, a[0], a[1])
+        return arc
 
     def goldtransition(self, parserstate, goldrels=None):
         SHIFT = self.mappings['action']['Shift']
@@ -385,32 +489,31 @@ class NewCovington(TransitionSystem):
         
 
         goldrels = goldrels or parserstate.goldrels
-        list1 = parserstate.list1
-        list2 = parserstate.list2
-        buf = parserstate.buf
+        top = parserstate.top
         head = parserstate.head
 
-        r = buf[0]
+        r = parserstate.front
         addedArc = False
         
-        if len(list1) == 0:
+        if top == 0:
             a = (SHIFT, -1, -1)
             return a
             
-        for si in xrange(len(list1)):
-            n =len(list1)-1
-            li = n-si
-            l = list1[li]     
+        # the closest gold neighbour of r in list1, if any; when it is out
+        # of the window its arc is given up on and r is shifted
+        left = self._goldindex(parserstate, goldrels)[3][r]
+        i = bisect_left(left, top)
+        if i > 0 and (self.window <= 0 or top-1-left[i-1] < self.window):
+            n = top-1
+            l = left[i-1]
+            si = n-l
             if l in goldrels[r]:
                 rel = goldrels[r][l]
                 a = (LEFTARC, si, rel)
-                addedArc = True
-                break
-            elif r in goldrels[l]:
+            else:
                 rel = goldrels[l][r]
                 a = (RIGHTARC, si, rel)
-                addedArc = True
-                break
+            addedArc = True
        
         if not addedArc:
             a = (SHIFT, -1, -1)
@@ -423,14 +526,23 @@ class NewCovington(TransitionSystem):
         RIGHTARC = self.mappings['action']['Right-Arc']
         if t[0] == SHIFT:
             if fpos is None:
-                return "Shift\t%s" % (pos[state.buf[0]])
+                return "Shift\t%s" % (pos[state.front])
             else:
-                return "Shift\t%s\t%s" % (pos[state.buf[0]], fpos[state.buf[0]])
+                return "Shift\t%s\t%s" % (pos[state.front], fpos[state.front])
         elif t[0] == LEFTARC:
             return "Left-Arc\t%d\t%s" % (t[1]+1, self.invmappings['rel'][t[2]])
         elif t[0] == RIGHTARC:
             return "Right-Arc\t%d\t%s" % (t[1]+1, self.invmappings['rel'][t[2]])
         
+    def trans_to_fields(self, t, state, pos, fpos=None):
+        SHIFT = self.mappings['action']['Shift']
+        if t[0] == SHIFT:
+            fields = {'action': t[0], 'pos': pos[state.front]}
+            if fpos is not None:
+                fields['fpos'] = fpos[state.front]
+            return fields
+        return {'action': t[0], 'n': t[1]+1, 'rel': t[2]}
+
     @classmethod
     def trans_from_line(self, line):
         if line[0] == 'Left-Arc':
@@ -490,45 +602,157 @@ class NewCovington(TransitionSystem):
         return a, rel
     
     
+class BatchedNewCovington(object):
+    """
+    NewCovington over a whole batch of beams at once.
+
+    Row r holds one parser state, stored like ParserState but as 2-D arrays
+    (one row per state), with the union-find links kept fully resolved so
+    that root[r, x] is always the root of x. Candidates are kept in the
+    same order as NewCovington's transition set (Shift, Left-Arcs by
+    increasing si, then Right-Arcs by increasing si), so masks, features
+    and action indices line up with the scalar system.
+    """
+
+    def __init__(self, transsys, lengths):
+        self.transsys = transsys
+        self.SHIFT = transsys.mappings['action']['Shift']
+        self.LEFTARC = transsys.mappings['action']['Left-Arc']
+        self.RIGHTARC = transsys.mappings['action']['Right-Arc']
+        self.RELS = len(transsys.mappings['rel'])
+
+        self.length = np.array(lengths, dtype=np.int32)
+        rows, n = len(self.length), self.length.max()
+        self.top = np.ones(rows, dtype=np.int32)
+        self.front = np.ones(rows, dtype=np.int32)
+        self.head = np.full((rows, n), -1, dtype=np.int32)
+        self.rel = np.full((rows, n), -1, dtype=np.int32)
+        self.root = np.tile(np.arange(n, dtype=np.int32), (rows, 1))
+
+        self._preparetransitionset()
+
+    def _preparetransitionset(self):
+        """ Recomputes the candidate arcs of every row """
+        rows, n = self.head.shape
+        r = np.arange(rows)[:, None]
+        front = np.minimum(self.front, n-1)
+
+        li = self.top[:, None] - 1 - np.arange(n)[None, :]
+        valid = li >= 0
+        if self.transsys.window > 0:
+            valid &= np.arange(n)[None, :] < self.transsys.window
+        li_ = np.maximum(li, 0)
+        fronthead = self.head[r[:, 0], front][:, None]
+        frontroot = self.root[r[:, 0], front][:, None]
+
+        # see create_cycles: li is headless, and front is headless whenever
+        # a Right-Arc is considered, so both checks are root comparisons
+        la = valid & (li != 0) & (self.head[r, li_] < 0) & ~((fronthead >= 0) & (frontroot == li))
+        ra = valid & (fronthead < 0) & (self.root[r, li_] != front[:, None])
+
+        self.has_shift = self.front < self.length
+        legal = np.concatenate([la, ra], axis=1) & self.has_shift[:, None]
+
+        # pack the legal candidates of each row to the left, in order
+        self.ncand = legal.sum(axis=1)
+        lr, lc = np.nonzero(legal)
+        slot = np.arange(len(lr)) - (np.cumsum(self.ncand) - self.ncand)[lr]
+        self.cand_type = np.zeros((rows, 2*n), dtype=np.int32)
+        self.cand_type[lr, slot] = np.where(lc < n, self.LEFTARC, self.RIGHTARC)
+        self.cand_li = np.zeros((rows, 2*n), dtype=np.int32)
+        self.cand_li[lr, slot] = li[lr, lc % n]
+
+    def transition_masks(self, size):
+        """ Same as NewCovington.transition_masks, for every row """
+        legal = np.where(self.has_shift, 1 + self.ncand * self.RELS, 0)
+        return (np.arange(size)[None, :] < legal[:, None]).astype(np.int8)
+
+    def featurize(self, feat_dim):
+        """
+        Returns the transition features featurize_state would give each row,
+        padded to feat_dim candidates, and the number of candidates per row
+        (0 for finished rows)
+        """
+        rows = len(self.length)
+        width = min(feat_dim - 1, self.ncand.max())
+        feats = np.zeros((rows, feat_dim, 5), dtype=np.int32)
+        sizes = np.where(self.has_shift, 1 + self.ncand, 0).astype(np.int32)
+
+        front = self.front[:, None]
+        kind = self.cand_type[:, :width]
+        li = self.cand_li[:, :width]
+        la = kind == self.LEFTARC
+        feats[:, 0] = np.stack([np.full(rows, self.SHIFT), np.full(rows, -1), np.full(rows, -1), self.front, np.full(rows, -1)], axis=1)
+        feats[:, 1:width+1] = np.stack([kind, np.where(la, front, li), np.where(la, li, front),
+                                        np.broadcast_to(front, li.shape), np.full(li.shape, -1)], axis=2)
+        feats[:, :width+1][np.arange(width+1)[None, :] >= sizes[:, None]] = 0
+        return feats, sizes
+
+    def advance(self, actions, parents=None):
+        """
+        Moves every row to the state of row parents[r], if given, and then
+        applies action index actions[r] to it; rows with a negative action
+        are left as they are. Returns the heads, dependents and relations
+        of the arcs built, -1 for rows that built none.
+        """
+        if parents is not None:
+            for name in ['top', 'front', 'length', 'head', 'rel', 'root', 'cand_type', 'cand_li']:
+                setattr(self, name, getattr(self, name)[parents])
+
+        actions = np.asarray(actions)
+        rows = len(actions)
+        h = np.full(rows, -1, dtype=np.int32)
+        d = np.full(rows, -1, dtype=np.int32)
+        rel = np.full(rows, -1, dtype=np.int32)
+
+        a = np.flatnonzero(actions > 0)
+        j = (actions[a] - 1) // self.RELS
+        li = self.cand_li[a, j]
+        la = self.cand_type[a, j] == self.LEFTARC
+        h[a] = np.where(la, self.front[a], li)
+        d[a] = np.where(la, li, self.front[a])
+        rel[a] = (actions[a] - 1) % self.RELS
+
+        self.head[a, d[a]] = h[a]
+        self.rel[a, d[a]] = rel[a]
+        root = self.root[a]
+        self.root[a] = np.where(root == d[a][:, None], self.root[a, h[a]][:, None], root)
+        self.top[a] = li
+
+        s = np.flatnonzero(actions == 0)
+        self.front[s] += 1
+        self.top[s] = self.front[s]
+
+        self._preparetransitionset()
+        return h, d, rel
+
+
 class Covington2(TransitionSystem):
     @classmethod
     def actions_list(self):
         return [ 'Shift', 'NoArc', 'Left-Arc', 'Right-Arc']
 
-    def create_cycles(self, parserstate, h, d):
-        head = parserstate.head
-        n = h
-        
-        if n == d:
-            return True 
-        
-        while n > 0:
-            n = head[n][0]
-            if n == d:
-                return True 
-        return False
-
     def _preparetransitionset(self, parserstate):
         SHIFT = self.mappings['action']['Shift']
         NOARC = self.mappings['action']['NoArc']
         LEFTARC = self.mappings['action']['Left-Arc']
         RIGHTARC = self.mappings['action']['Right-Arc']
         
-        list1, list2, buf, head = parserstate.list1, parserstate.list2, parserstate.buf, parserstate.head
+        top, front, head = parserstate.top, parserstate.front, parserstate.head
 
         t = []
         
-        if len(buf) != 0:
+        if front < parserstate.length:
             
-            if len(list1) == 0:
+            if top == 0:
                 t += [(SHIFT, -1)]
             else:  
                 t += [(SHIFT, -1)]
                 t += [(NOARC, 0)]
-                if list1[len(list1)-1] != 0 and head[list1[len(list1)-1]][0] < 0 and not self.create_cycles(parserstate, head[buf[0]][0], list1[len(list1)-1]):
+                if top-1 != 0 and head[top-1] < 0 and not self.create_cycles(parserstate, head[front], top-1):
                     t += [(LEFTARC, 0)]
             
-                if head[buf[0]][0] < 0 and not self.create_cycles(parserstate, head[list1[len(list1)-1]][0], buf[0]):
+                if head[front] < 0 and not self.create_cycles(parserstate, head[top-1], front):
                     t += [(RIGHTARC, 0)]
         
         parserstate._transitionset = t
@@ -553,33 +777,30 @@ class Covington2(TransitionSystem):
            rel = action[-1]
            a = action[:-1]
 
-        list1 = parserstate.list1
-        list2 = parserstate.list2
-        buf = parserstate.buf
+        top = parserstate.top
+        front = parserstate.front
   
         
         
+        arc = None
         if a[0] == LEFTARC:
-            n = len(list1)-1 
-            parserstate.head[list1[n]] = [buf[0], rel]
-            parserstate.list2 = [list1[n]]+list2
-            parserstate.list1 = list1[:n]
+            n = top-1 
+            arc = parserstate.add_arc(front, n, rel)
+            parserstate.top = n
         elif a[0] == RIGHTARC:
-            n = len(list1)-1 
-            parserstate.head[buf[0]] = [list1[n], rel]
-            parserstate.list2 = [list1[n]]+list2
-            parserstate.list1 = list1[:n]
+            n = top-1 
+            arc = parserstate.add_arc(n, front, rel)
+            parserstate.top = n
         
         elif a[0] == SHIFT:# or len(list1) == 1:
-            parserstate.list1 = list1+list2+[buf[0]]
-            parserstate.list2 = [];
-            parserstate.buf = buf[1:]
+            parserstate.top = front+1
+            parserstate.front = front+1
         elif a[0] == NOARC:
-	    n = len(list1)-1
-            parserstate.list2 = [list1[n]]+list2
-            parserstate.list1 = list1[:n]
+	    n = top-1
+            parserstate.top = n-a[1]
           
         self._preparetransitionset(parserstate)
+        return arc
 
     def goldtransition(self, parserstate, goldrels=None):
         SHIFT = self.mappings['action']['Shift']
@@ -589,34 +810,23 @@ class Covington2(TransitionSystem):
         
 
         goldrels = goldrels or parserstate.goldrels
-        list1 = parserstate.list1
-        list2 = parserstate.list2
-        buf = parserstate.buf
+        top = parserstate.top
         head = parserstate.head
 
-        r = buf[0]
+        r = parserstate.front
         addedArc = False
-        noleftchildren = True
-        for x in list1:
-            if x in goldrels[r]:
-                noleftchildren = False
-                break    
-        
+        _, goldhead, leftmost, _ = self._goldindex(parserstate, goldrels)
+        noleftchildren = leftmost[r] >= top
+        norighthead = not 0 <= goldhead[r] < top
         
-        norighthead = True
-        for x in list1:
-            if r in goldrels[x]:
-                norighthead = False
-                break
         
         
-        
-        if len(list1) == 0:
+        if top == 0:
             a = (SHIFT, -1, -1)
             return a
             
         
-        l = list1[len(list1)-1]     
+        l = top-1     
         if l in goldrels[r]:
             rel = goldrels[r][l]
             a = (LEFTARC, 0, rel)
@@ -636,9 +846,9 @@ class Covington2(TransitionSystem):
         RIGHTARC = self.mappings['action']['Right-Arc']
         if t[0] == SHIFT:
             if fpos is None:
-                return "Shift\t%s" % (pos[state.buf[0]])
+                return "Shift\t%s" % (pos[state.front])
             else:
-                return "Shift\t%s\t%s" % (pos[state.buf[0]], fpos[state.buf[0]])
+                return "Shift\t%s\t%s" % (pos[state.front], fpos[state.front])
         elif t[0] == LEFTARC:
             return "Left-Arc\t%d\t%s" % (t[1]+1, self.invmappings['rel'][t[2]])
         elif t[0] == RIGHTARC:
@@ -647,6 +857,16 @@ class Covington2(TransitionSystem):
             #return "NoArc"
             return "NoArc\t%d\t%s" % (t[1]+1, self.invmappings['rel'][t[2]])
 
+    def trans_to_fields(self, t, state, pos, fpos=None):
+        SHIFT = self.mappings['action']['Shift']
+        NOARC = self.mappings['action']['NoArc']
+        if t[0] == SHIFT:
+            fields = {'action': t[0], 'pos': pos[state.front]}
+            if fpos is not None:
+                fields['fpos'] = fpos[state.front]
+            return fields
+        return {'action': t[0], 'n': t[1]+1, 'rel': t[2]}
+
     @classmethod
     def trans_from_line(self, line):
         if line[0] == 'Left-Arc':
@@ -728,52 +948,39 @@ class Covington3(TransitionSystem):
     def actions_list(self):
         return [ 'Shift', 'NoArc', 'Left-Arc', 'Right-Arc']
 
-    def create_cycles(self, parserstate, h, d):
-        head = parserstate.head
-        n = h
-        
-        if n == d:
-            return True 
-        
-        while n > 0:
-            n = head[n][0]
-            if n == d:
-                return True 
-        return False
-
     def _preparetransitionset(self, parserstate):
         SHIFT = self.mappings['action']['Shift']
         NOARC = self.mappings['action']['NoArc']
         LEFTARC = self.mappings['action']['Left-Arc']
         RIGHTARC = self.mappings['action']['Right-Arc']
         
-        list1, list2, buf, head = parserstate.list1, parserstate.list2, parserstate.buf, parserstate.head
+        top, front, head = parserstate.top, parserstate.front, parserstate.head
 
         t = []
         
-        if len(buf) != 0:
+        if front < parserstate.length:
             
-            if len(list1) == 0:
+            if top == 0:
                 t += [(SHIFT, -1)]
             else:  
                 t += [(SHIFT, -1)]
                 t += [(NOARC, 0)]
                         
-                for si in xrange(len(list1)):
-                    n = len(list1)-1
+                for si in xrange(top):
+                    n = top-1
                     li = n - si
                     if si == 3:
                         break
-                    if list1[li] != 0 and head[list1[li]][0] < 0 and not self.create_cycles(parserstate, head[buf[0]][0], list1[li]):
+                    if li != 0 and head[li] < 0 and not self.create_cycles(parserstate, head[front], li):
                         t += [(LEFTARC, si)]
                     
-                for si in xrange(len(list1)):
-                    n = len(list1)-1
+                for si in xrange(top):
+                    n = top-1
                     li = n - si
                     if si == 3:
                         break
                     
-                    if head[buf[0]][0] < 0 and not self.create_cycles(parserstate, head[list1[li]][0], buf[0]):
+                    if head[front] < 0 and not self.create_cycles(parserstate, head[li], front):
                         t += [(RIGHTARC, si)]
                 
         
@@ -800,33 +1007,30 @@ class Covington3(TransitionSystem):
            rel = action[-1]
            a = action[:-1]
 
-        list1 = parserstate.list1
-        list2 = parserstate.list2
-        buf = parserstate.buf
+        top = parserstate.top
+        front = parserstate.front
   
         
+        arc = None
         if a[0] == LEFTARC:
-            n = len(list1)-1
+            n = top-1
             si = a[1] 
-            parserstate.head[list1[n-si]] = [buf[0], rel]
-            parserstate.list2 = list1[(n-si):]+list2
-            parserstate.list1 = list1[:(n-si)]
+            arc = parserstate.add_arc(front, n-si, rel)
+            parserstate.top = n-si
         elif a[0] == RIGHTARC:
-            n = len(list1)-1
+            n = top-1
             si = a[1]
-            parserstate.head[buf[0]] = [list1[n-si], rel]
-            parserstate.list2 = list1[(n-si):]+list2
-            parserstate.list1 = list1[:(n-si)]
+            arc = parserstate.add_arc(n-si, front, rel)
+            parserstate.top = n-si
         
         elif a[0] == SHIFT:
-            parserstate.list1 = list1+list2+[buf[0]]
-            parserstate.list2 = [];
-            parserstate.buf = buf[1:]
+            parserstate.top = front+1
+            parserstate.front = front+1
         elif a[0] == NOARC:
-            n = len(list1)-1
-            parserstate.list2 = [list1[n]]+list2
-            parserstate.list1 = list1[:n]
+            n = top-1
+            parserstate.top = n
         self._preparetransitionset(parserstate)
+        return arc
 
     def goldtransition(self, parserstate, goldrels=None):
         SHIFT = self.mappings['action']['Shift']
@@ -836,34 +1040,23 @@ class Covington3(TransitionSystem):
         
 
         goldrels = goldrels or parserstate.goldrels
-        list1 = parserstate.list1
-        list2 = parserstate.list2
-        buf = parserstate.buf
+        top = parserstate.top
         head = parserstate.head
 
-        r = buf[0]
+        r = parserstate.front
         addedArc = False
-        noleftchildren = True
-        for x in list1:
-            if x in goldrels[r]:
-                noleftchildren = False
-                break    
-        
+        _, goldhead, leftmost, _ = self._goldindex(parserstate, goldrels)
+        noleftchildren = leftmost[r] >= top
+        norighthead = not 0 <= goldhead[r] < top
         
-        norighthead = True
-        for x in list1:
-            if r in goldrels[x]:
-                norighthead = False
-                break
         
         
-        
-        if len(list1) == 0:
+        if top == 0:
             a = (SHIFT, -1, -1)
             return a
             
       
-        l = list1[len(list1)-1]     
+        l = top-1     
         if l in goldrels[r]:
             rel = goldrels[r][l]
             a = (LEFTARC, 0, rel)
@@ -900,9 +1093,9 @@ class Covington3(TransitionSystem):
         RIGHTARC = self.mappings['action']['Right-Arc']
         if t[0] == SHIFT:
             if fpos is None:
-                return "Shift\t%s" % (pos[state.buf[0]])
+                return "Shift\t%s" % (pos[state.front])
             else:
-                return "Shift\t%s\t%s" % (pos[state.buf[0]], fpos[state.buf[0]])
+                return "Shift\t%s\t%s" % (pos[state.front], fpos[state.front])
         elif t[0] == LEFTARC:
             return "Left-Arc\t%d\t%s" % (t[1]+1, self.invmappings['rel'][t[2]])
         elif t[0] == RIGHTARC:
@@ -911,6 +1104,15 @@ class Covington3(TransitionSystem):
             #return "NoArc"
             return "NoArc\t%d\t%s" % (t[1]+1, self.invmappings['rel'][t[2]])
 
+    def trans_to_fields(self, t, state, pos, fpos=None):
+        SHIFT = self.mappings['action']['Shift']
+        if t[0] == SHIFT:
+            fields = {'action': t[0], 'pos': pos[state.front]}
+            if fpos is not None:
+                fields['fpos'] = fpos[state.front]
+            return fields
+        return {'action': t[0], 'n': t[1]+1, 'rel': t[2]}
+
     @classmethod
     def trans_from_line(self, line):
         if line[0] == 'Left-Arc':
@@ -1,10 +1,20 @@
 import logging
+import multiprocessing
+import os
+import Queue
+import random
+import sys
+import threading
+import time
 import os.path as op
 from smart_open import smart_open
 import cPickle as pickle
+from cache import read_key, write_key, remove_path
 from parserstate import ParserState
 from transition import Covington, NewCovington, Covington2, Covington3
 import numpy as np
+from itertools import izip, islice
+from cStringIO import StringIO
 
 transition_dims = ['action', 'n', 'rel', 'pos', 'fpos']
 transition_pos = {v:i for i, v in enumerate(transition_dims)}
@@ -14,162 +24,354 @@ def transsys_lookup(k):
     lookup = {"Cov" : Covington, "NCov" : NewCovington, "Cov2" : Covington2, "Cov3" : Covington3}
     return lookup[k]
 
-def process_example(conll_lines, seq_lines, vocab, mappings, transsys, fpos=False, log=None):
+def _fields_to_vector(fields, mappings):
+    """ Returns the vector form of the fields of a transition, mapping names to integers """
+    vector_form = []
+    for k in transition_dims:
+        if k in fields:
+            if k in mappings and isinstance(fields[k], basestring):
+                fields[k] = mappings[k][fields[k]]
+            vector_form += [fields[k]]
+        else:
+            vector_form += [-1] # this should never be used
+    return vector_form
+
+def seq_lines_to_vectors(seq_lines, mappings, transsys):
+    """ Returns the vector forms of the transitions on the split lines of an oracle sequence """
+    res = []
+    for line in seq_lines:
+        res += [_fields_to_vector(transsys.trans_from_line(line), mappings)]
+    return res
+
+def seq_line_from_vector(vector_form, invmappings):
+    """ Returns the sequence file line of a transition in vector form """
+    action, n, rel, pos, fpos = vector_form
+    line = [invmappings['action'][action]]
+    if n >= 0:
+        line += ['%d' % n]
+    if rel >= 0:
+        line += [invmappings['rel'][rel]]
+    if pos >= 0:
+        line += [invmappings['pos'][pos]]
+    if fpos >= 0:
+        line += [invmappings['fpos'][fpos]]
+    return '\t'.join(line)
+
+def process_example(conll_lines, seq_lines, vocab, mappings, transsys, fpos=False, log=None, seq_vectors=None):
+    """
+    Builds an example from the lines of a sentence and its oracle sequence,
+    already split into fields, or the sequence in vector form from a binary
+    sequence file
+    """
     if fpos:
         res = [[] for _ in xrange(4)]
     else:
         res = [[] for _ in xrange(3)]
-    res[0] = [vocab[u'<ROOT>']] + [vocab[u'<UNK>'] if line.split()[1] not in vocab else vocab[line.split()[1]] for line in conll_lines]
-    for line in seq_lines:
-        line = line.split()
+    res[0] = [vocab[u'<ROOT>']] + [vocab[u'<UNK>'] if line[1] not in vocab else vocab[line[1]] for line in conll_lines]
+    if seq_vectors is not None:
+        res[1] = seq_vectors.tolist()
+    else:
         try:
-            fields = transsys.trans_from_line(line)
+            res[1] = seq_lines_to_vectors(seq_lines, mappings, transsys)
         except ValueError as e:
             log.error('Encountered unknown transition type "%s" in sequences file, ignoring...' % (str(e)))
             return None
 
-        vector_form = []
-        for k in transition_dims:
-            if k in fields:
-                if k in mappings:
-                    fields[k] = mappings[k][fields[k]]
-                vector_form += [fields[k]]
-            else:
-                vector_form += [-1] # this should never be used
-
-        res[1] += [vector_form]
-
 
     # gold POS
-    res[2] = [len(mappings['pos'])] + [mappings['pos'][line.split()[3]] for line in conll_lines]
+    res[2] = [len(mappings['pos'])] + [mappings['pos'][line[3]] for line in conll_lines]
     if fpos:
         # fine-grained POS
-        res[3] = [len(mappings['fpos'])] + [mappings['fpos'][line.split()[4]] for line in conll_lines]
+        res[3] = [len(mappings['fpos'])] + [mappings['fpos'][line[4]] for line in conll_lines]
 
     return tuple(res)
 
-def read_data(conll_file, seq_file, vocab, mappings, transsys, fpos=False, log=None):
-    log.info('Reading dependency parse data...')
-    max_sent_len = -1
-    max_seq_len = -1
-    res = []
+def iter_blocks(f):
+    """
+    Yields the blocks of lines of a CoNLL or sequence file, with every line
+    split into fields. Only blocks ended by an empty line are complete, so
+    anything after the last one is ignored.
+    """
+    block = []
+    for line in f:
+        line = line.decode('utf-8').split()
+        if len(line) == 0:
+            yield block
+            block = []
+        else:
+            block.append(line)
+
+def iter_data(conll_file, seq_file, vocab, mappings, transsys, fpos=False, log=None):
+    """
+    Yields the examples of a CoNLL file, paired with their oracle sequences
+    if seq_file is given, one at a time and without holding the rest of the
+    files in memory
+    """
     with smart_open(conll_file, 'r') as conllf:
-        if seq_file is not None:
+        if seq_file is not None and op.isdir(seq_file):
+            for lines1, vector_forms in izip(iter_blocks(conllf), SeqFile.load(seq_file)):
+                yield process_example(lines1, None, vocab, mappings, transsys, fpos, log=log, seq_vectors=vector_forms)
+        elif seq_file is not None:
             with smart_open(seq_file, 'r') as seqf:
-                lines1 = []
-                lines2 = []
-
-                while True:
-                    line1 = conllf.readline().decode('utf-8')
-
-                    while line1:
-                        line1_ = line1.strip()
-
-                        if len(line1_) <= 0:
-                            break
-
-                        lines1 += [line1_]
-                        line1 = conllf.readline().decode('utf-8')
-
-                    line2 = seqf.readline().decode('utf-8')
-
-                    while line2:
-                        line2_ = line2.strip()
-
-                        if len(line2_) <= 0:
-                            break
-
-                        lines2 += [line2_]
-                        line2 = seqf.readline().decode('utf-8')
-
-                    if not line1 or not line2:
-                        break
-
-                    if len(lines1) + 1 > max_sent_len:
-                        max_sent_len = len(lines1) + 1
-                    if len(lines2) > max_seq_len:
-                        max_seq_len = len(lines2)
-                    t = process_example(lines1, lines2, vocab, mappings, transsys, fpos)
+                for lines1, lines2 in izip(iter_blocks(conllf), iter_blocks(seqf)):
+                    t = process_example(lines1, lines2, vocab, mappings, transsys, fpos, log=log)
                     if t:
-                        res += [t]
+                        yield t
+        else:
+            for lines1 in iter_blocks(conllf):
+                t = process_example(lines1, [], vocab, mappings, transsys, fpos, log=log)
+                if t:
+                    yield t
+
+def scan_lengths(conll_file, seq_file):
+    """
+    Returns the maximum sentence length (counting <ROOT>) and transition
+    count of a dataset by counting lines, for sizing the model before
+    streaming the examples with iter_data
+    """
+    def block_lengths(f, count):
+        n = 0
+        for line in f:
+            if len(line.strip()) <= 0:
+                yield n
+                n = 0
+            else:
+                n += count(line)
 
-                    lines1 = []
-                    lines2 = []
+    max_sent_len = -1
+    max_seq_len = -1
+    with smart_open(conll_file, 'r') as conllf:
+        if seq_file is not None and op.isdir(seq_file):
+            for n1 in block_lengths(conllf, lambda line: 1):
+                max_sent_len = max(max_sent_len, n1 + 1)
+            max_seq_len = SeqFile.load(seq_file).max_steps
+        elif seq_file is not None:
+            with smart_open(seq_file, 'r') as seqf:
+                for n1, n2 in izip(block_lengths(conllf, lambda line: 1), block_lengths(seqf, lambda line: 1)):
+                    max_sent_len = max(max_sent_len, n1 + 1)
+                    max_seq_len = max(max_seq_len, n2)
         else:
-            lines1 = []
-            while True:
-                line1 = conllf.readline().decode('utf-8')
+            for n1 in block_lengths(conllf, lambda line: 1):
+                max_sent_len = max(max_sent_len, n1 + 1)
 
-                while line1:
-                    line1_ = line1.strip()
+    return max_sent_len, max_seq_len
 
-                    if len(line1_) <= 0:
-                        break
+def read_data(conll_file, seq_file, vocab, mappings, transsys, fpos=False, log=None):
+    log.info('Reading dependency parse data...')
+    max_sent_len = -1
+    max_seq_len = -1
+    res = []
+    for t in iter_data(conll_file, seq_file, vocab, mappings, transsys, fpos, log=log):
+        if len(t[0]) > max_sent_len:
+            max_sent_len = len(t[0])
+        if seq_file is not None and len(t[1]) > max_seq_len:
+            max_seq_len = len(t[1])
+        res += [t]
 
-                    lines1 += [line1_]
-                    line1 = conllf.readline().decode('utf-8')
+    sent_length = max_sent_len
+    log.info('%d examples read, max sentence length %d, max transition count %d.' % (len(res), sent_length, max_seq_len))
+    return res, sent_length, max_seq_len
 
-                if not line1:
-                    break
+def _load_artifact(kind, path, key, cache, load, looks_like, log=None, load_unkeyed=False):
+    """
+    Loads an artifact from path, or failing that from the cache, as long as
+    it was built from inputs with the given key (None to skip the check);
+    returns None if it has to be built. Artifacts in the expected format
+    (see looks_like) but saved without a key are only read with
+    load_unkeyed. Cached artifacts are read where they are,
+    and never copied over path, which may be in another format. Raises
+    ValueError if path holds something that a new artifact may not replace
+    (see _replaceable), before anything is built.
+    """
+    if path is not None and op.exists(path):
+        saved_key = read_key(path)
+        if key is None or saved_key == key:
+            return load(path)
+        if saved_key is None and load_unkeyed and looks_like(path):
+            log.warn('"%s" has no record of the inputs it was built from, reusing it as asked.' % (path))
+            return load(path)
+        if not _replaceable(path, looks_like):
+            if saved_key is None and looks_like(path):
+                raise ValueError('"%s" has no record of the inputs it was built from; pass --load_unkeyed to reuse it, or remove it' % (path))
+            raise ValueError('"%s" exists and does not look like saved %s, refusing to overwrite it' % (path, kind))
+        log.warn('"%s" was not built from the current inputs, not reusing it.' % (path))
+
+    if cache is None or key is None:
+        return None
+
+    cached = cache.get(kind, key)
+    if cached is None:
+        return None
+
+    if path is not None:
+        log.info('Reading %s from the cache, "%s" is left as it is.' % (kind, path))
+    return load(cached)
+
+def _replaceable(path, looks_like):
+    """
+    Whether a new artifact may be saved over path: only artifacts that were
+    saved with a key, and so by this code, and that are still in the
+    expected format are ever removed
+    """
+    return not op.exists(path) or (read_key(path) is not None and looks_like(path))
+
+def _store_artifact(kind, path, key, cache, save, looks_like):
+    """
+    Saves a newly built artifact to path and to the cache, replacing the
+    previous artifact at path. Raises ValueError rather than remove
+    anything else.
+    """
+    if path is not None and not _replaceable(path, looks_like):
+        raise ValueError('"%s" exists and does not look like saved %s, refusing to overwrite it' % (path, kind))
+
+    if cache is not None and key is not None:
+        cache.put(kind, key, save)
+
+    if path is not None:
+        if op.exists(path):
+            remove_path(path)
+        save(path)
+        if key is not None:
+            write_key(path, key)
+
+def _load_vocab(vocab_file):
+    with smart_open(vocab_file, 'rb') as f:
+        vocab = pickle.load(f)
+        vecs = pickle.load(f)
+        i1 = pickle.load(f)
+    return vocab, vecs, i1
 
-                if len(lines1) + 1 > max_sent_len:
-                    max_sent_len = len(lines1) + 1
-                t = process_example(lines1, [], vocab, mappings, transsys, fpos)
-                if t:
-                    res += [t]
+def _save_vocab(vocab_file, vocab, vecs, i1):
+    with smart_open(vocab_file, 'wb') as f:
+        pickle.dump(vocab, f, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(vecs, f, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(i1, f, pickle.HIGHEST_PROTOCOL)
 
-                lines1 = []
+# rows of a binary word vector matrix processed at a time
+WORDVEC_BLOCK = 65536
 
-    sent_length = max_sent_len
-    log.info('%d examples read, max sentence length %d, max transition count %d.' % (len(res), sent_length, max_seq_len))
-    return res, sent_length, max_seq_len
+def wordvec_index_file(wordvec_file):
+    """ The word list that goes with a binary word vector matrix """
+    return op.splitext(wordvec_file)[0] + '.words'
 
-def read_vocab(conll_file, wordvec_file, vocab_file, wordvec_dim, min_count=3, log=None):
-    log.info('Reading vocabulary...')
+def iter_wordvec_text(wordvec_file, wordvec_dim, log=None):
+    """ Yields the words and vectors in a word vector text file, skipping repeated words """
+    seen = set()
+    with smart_open(wordvec_file, 'r') as f:
+        for line in f:
+            try:
+                line = line.decode('utf-8').strip().split()
+            except UnicodeDecodeError:
+                continue
+            word = " ".join(line[0:(len(line) - wordvec_dim)])
+            if word in seen:
+                continue
 
-    if vocab_file is not None and op.exists(vocab_file):
-        with smart_open(vocab_file, 'rb') as f:
-            vocab = pickle.load(f)
-            vecs = pickle.load(f)
-            i1 = pickle.load(f)
+            if wordvec_dim != len(line) - len(word.split()):
+                log.warn('Specified word embedding dim(%d) is different from that in the word embeddings file(%d) for word "%s", skipping...' % (wordvec_dim, len(line)-len(word.split()), word))
+                continue
 
-        log.info('Read %d words from saved vocabulary file "%s".' % (len(vocab), vocab_file))
+            seen.add(word)
+            yield word, np.array(line[len(line)-wordvec_dim:], dtype=floatX)
 
-        return vocab, vecs, i1
+def convert_wordvecs(wordvec_file, out_file, wordvec_dim, log=None):
+    """
+    Converts a word vector text file to a binary .npy matrix, with the words
+    in a text file next to it, one per line
+    """
+    tmp_file = out_file + '.tmp'
+    count = 0
+    with open(tmp_file, 'wb') as fvec, open(wordvec_index_file(out_file), 'w') as fword:
+        for word, vec in iter_wordvec_text(wordvec_file, wordvec_dim, log=log):
+            fvec.write(vec.tobytes())
+            fword.write(word.encode('utf-8') + '\n')
 
-    vocab = dict()
-    vecs = []
-    i = i1 = 0
-    if wordvec_file and op.exists(wordvec_file):
-        with smart_open(wordvec_file, 'r') as f:
-            for line in f:
-                try:
-                    line = line.decode('utf-8').strip().split()
-                except UnicodeDecodeError:
-                    continue
-                word = " ".join(line[0:(len(line) - wordvec_dim)])
-                if word not in vocab:
-                    vocab[word] = i
-                    i += 1
+            count += 1
+            if count % 100000 == 0:
+                log.info('Converted %d word vectors...' % (count))
 
-                    if i % 10000 == 0:
-                        log.info('Read %d words from the word vector file' % (i))
+    _raw_to_npy(tmp_file, out_file, floatX, (count, wordvec_dim))
 
-                    if wordvec_dim is not None and wordvec_dim != len(line) - len(word.split()):
-                        log.warn('Specified word embedding dim(%d) is different from that in the word embeddings file(%d) for word "%s", skipping...' % (wordvec_dim, len(line)-len(word.split()), word))
-                    elif wordvec_dim is None:
-                        wordvec_dim = len(line) - 1
+    return count
 
-                    vecs += [np.array([float(x) for x in line[len(word.split()):]], dtype=floatX)]
+def _raw_to_npy(raw_file, out_file, dtype, shape):
+    """ Turns a file of raw array rows into a .npy file a block at a time, removing it """
+    if shape[0] == 0:
+        np.save(out_file, np.zeros(shape, dtype=dtype))
+    else:
+        raw = np.memmap(raw_file, dtype=dtype, mode='r', shape=shape)
+        out = np.lib.format.open_memmap(out_file, mode='w+', dtype=dtype, shape=shape)
+        for b in xrange(0, shape[0], WORDVEC_BLOCK):
+            out[b:b+WORDVEC_BLOCK] = raw[b:b+WORDVEC_BLOCK]
+        out.flush()
+        del raw, out
+    os.remove(raw_file)
+
+def read_wordvecs(wordvec_file, wordvec_dim, keep=None, log=None):
+    """
+    Reads pretrained word vectors from a text file or a binary .npy matrix,
+    keeping only the words in keep if it is given. Returns the words and
+    vectors kept, and the mean and standard deviation of all the vectors in
+    the file, which are accumulated in one pass without holding them all.
+    """
+    total = np.zeros(wordvec_dim, dtype=np.float64)
+    total_sq = np.zeros(wordvec_dim, dtype=np.float64)
+
+    if wordvec_file.endswith('.npy'):
+        mat = np.load(wordvec_file, mmap_mode='r')
+        with smart_open(wordvec_index_file(wordvec_file), 'r') as f:
+            words = [line.decode('utf-8').rstrip('\n') for line in f]
+        assert(mat.shape == (len(words), wordvec_dim))
+
+        for b in xrange(0, len(mat), WORDVEC_BLOCK):
+            block = np.asarray(mat[b:b+WORDVEC_BLOCK], dtype=np.float64)
+            total += block.sum(axis=0)
+            total_sq += np.square(block).sum(axis=0)
+        n = len(words)
+
+        if keep is None:
+            vecs = np.array(mat, dtype=floatX)
+        else:
+            idx = [j for j, w in enumerate(words) if w in keep]
+            words = [words[j] for j in idx]
+            vecs = np.array(mat[idx], dtype=floatX)
+    else:
+        words, vecs = [], []
+        n = 0
+        for word, vec in iter_wordvec_text(wordvec_file, wordvec_dim, log=log):
+            total += vec
+            total_sq += np.square(vec, dtype=np.float64)
+            n += 1
+            if n % 100000 == 0:
+                log.info('Read %d words from the word vector file' % (n))
+
+            if keep is None or word in keep:
+                words += [word]
+                vecs += [vec]
+        vecs = np.array(vecs, dtype=floatX) if len(vecs) > 0 else np.zeros((0, wordvec_dim), dtype=floatX)
+
+    mu = total / max(n, 1)
+    sigma = np.sqrt(np.maximum(total_sq / max(n, 1) - np.square(mu), 0))
+    log.debug('%d words read from word vector file, %d kept' % (n, len(words)))
+
+    return words, vecs, mu.astype(floatX), sigma.astype(floatX)
+
+def read_vocab(conll_file, wordvec_file, vocab_file, wordvec_dim, min_count=3, log=None, cache=None, key=None, wordvec_corpora=None, load_unkeyed=False):
+    """
+    Builds the vocabulary and word embeddings for a CoNLL file, or reads them
+    from vocab_file. If wordvec_corpora is a list of CoNLL files, only the
+    pretrained vectors of words in conll_file and those files are loaded.
+    """
+    log.info('Reading vocabulary...')
 
-        i1 = i
-        log.debug('%d words read from word vector file' % i)
+    res = _load_artifact('vocab', vocab_file, key, cache, _load_vocab, op.isfile, log=log, load_unkeyed=load_unkeyed)
+    if res is not None:
+        log.info('Read %d words from saved vocabulary.' % (len(res[0])))
 
-    i0 = i1
+        return res
 
     count = dict()
     with smart_open(conll_file, 'r') as f:
-        totalcount = 0
         for line in f:
             line = line.strip()
             if len(line) <= 0:
@@ -181,59 +383,84 @@ def read_vocab(conll_file, wordvec_file, vocab_file, wordvec_dim, min_count=3, l
             else:
                 count[line[1]] = 1
 
-                if line[1] not in vocab:
-                    totalcount += 1
+                if len(count) % 10000 == 0:
+                    log.info('Read %d words from the CoNLL file' % (len(count)))
 
-                    if totalcount % 10000 == 0:
-                        log.info('Read %d words from the CoNLL file' % (totalcount))
+    vocab = dict()
+    pretrained = np.zeros((0, wordvec_dim), dtype=floatX)
+    i = i1 = 0
+    if wordvec_file and op.exists(wordvec_file):
+        keep = None
+        if wordvec_corpora is not None:
+            # words are looked up as they are and lowercased
+            keep = set()
+            for corpus in [conll_file] + wordvec_corpora:
+                with smart_open(corpus, 'r') as f:
+                    for line in f:
+                        line = line.split()
+                        if len(line) > 1:
+                            keep.add(line[1])
+                            keep.add(line[1].lower())
+
+        words, pretrained, mu, sigma = read_wordvecs(wordvec_file, wordvec_dim, keep=keep, log=log)
+        for word in words:
+            vocab[word] = i
+            i += 1
 
-        pruned = 0
-        for w in count:
-            if count[w] < min_count:
-                pruned += 1
-                continue
+        i1 = i
 
-            if w not in vocab and w.lower() in vocab:
-                vecs += [vecs[vocab[w.lower()]]]
-                i1 += 1
-                vocab[w] = i
-                i += 1
+    i0 = i1
 
-        for w in count:
-            if count[w] < min_count:
-                continue
+    # rows for the words that have no pretrained vector of their own: a
+    # pretrained row index for lowercase fallbacks, None for random ones
+    extra = []
+    pruned = 0
+    for w in count:
+        if count[w] < min_count:
+            pruned += 1
+            continue
 
-            if w not in vocab and w.lower() not in vocab:
-                vecs += [np.random.randn(wordvec_dim).astype(floatX)]
-                vocab[w] = i
-                i += 1
+        if w not in vocab and w.lower() in vocab:
+            extra += [vocab[w.lower()]]
+            i1 += 1
+            vocab[w] = i
+            i += 1
 
-        for w in ['<UNK>', '<ROOT>']:
-            if w not in vocab:
-                vocab[w] = i
-                i += 1
+    for w in count:
+        if count[w] < min_count:
+            continue
+
+        if w not in vocab and w.lower() not in vocab:
+            extra += [None]
+            vocab[w] = i
+            i += 1
+
+    for w in ['<UNK>', '<ROOT>']:
+        if w not in vocab:
+            vocab[w] = i
+            i += 1
 
-            vecs += [np.random.randn(wordvec_dim).astype(floatX)]
+        extra += [None]
 
-        log.debug('%d words retained from CoNLL file, %d initialized with word vectors, %d low frequency words pruned' % (i-i0, i1-i0, pruned))
+    log.debug('%d words retained from CoNLL file, %d initialized with word vectors, %d low frequency words pruned' % (i-i0, i1-i0, pruned))
 
     log.info('%d words read.' % (i))
 
     log.info('Normalizing word embeddings...')
-    vecs = np.array(vecs, dtype=floatX)
+    # grow the pretrained matrix in place rather than copying it
+    vecs = pretrained
+    vecs.resize((i0 + len(extra), wordvec_dim), refcheck=False)
+    for j, src in enumerate(extra):
+        vecs[i0 + j] = vecs[src] if src is not None else np.random.randn(wordvec_dim).astype(floatX)
 
     # re-center and normalize word vectors
     if i1 > 0:
-        mu = np.mean(vecs[:i0], axis = 0)
-        sigma = np.std(vecs[:i0], axis = 0)
-        vecs[:i1] = (vecs[:i1] - mu.reshape(1, -1)) / sigma.reshape(1, -1)
+        vecs[:i1] -= mu.reshape(1, -1)
+        vecs[:i1] /= sigma.reshape(1, -1)
 
-    if vocab_file is not None:
-        log.info('Saving vocab and normalized embeddings to "%s"...' % (vocab_file))
-        with smart_open(vocab_file, 'wb') as f:
-            pickle.dump(vocab, f, pickle.HIGHEST_PROTOCOL)
-            pickle.dump(vecs, f, pickle.HIGHEST_PROTOCOL)
-            pickle.dump(i1, f, pickle.HIGHEST_PROTOCOL)
+    if vocab_file is not None or cache is not None:
+        log.info('Saving vocab and normalized embeddings...')
+        _store_artifact('vocab', vocab_file, key, cache, lambda path: _save_vocab(path, vocab, vecs, i1), op.isfile)
 
         log.info('Done.')
 
@@ -262,9 +489,8 @@ def read_mappings(mappings_file, transsys, log=None):
     return res, res2
 
 def featurize_state(state, mappings, t=None):
-    list1 = state.list1
-    list2 = state.list2
-    buf = state.buf
+    top = state.top
+    front = state.front
     head = state.head
 
     ACTION = transition_pos['action']
@@ -301,14 +527,14 @@ def featurize_state(state, mappings, t=None):
 
 
         buffer_top3 = [-1] * 2
-        buffer_top3[:min(len(buf), 2)] = buf[:min(len(buf), 2)]
+        buffer_top3[:min(state.length-front, 2)] = range(front, min(state.length, front+2))
         list1_top2 = [-1] * 2
         
-        if len(list1) >= 2 :
-            list1_top2[0] = list1[len(list1)-2]
-            list1_top2[1] = list1[len(list1)-1]
-        elif len(list1) == 1 :
-            list1_top2[1] = list1[len(list1)-1] 
+        if top >= 2 :
+            list1_top2[0] = top-2
+            list1_top2[1] = top-1
+        elif top == 1 :
+            list1_top2[1] = top-1 
          
         feat = tuple(list1_top2 + buffer_top3 + [pos])
         
@@ -337,18 +563,18 @@ def featurize_state(state, mappings, t=None):
         num_ra=0
         for i, t1 in enumerate(possible_trans):
             if t1[0] == SHIFT:
-                feat[i] = (SHIFT, -1, -1, buf[0], pos)
+                feat[i] = (SHIFT, -1, -1, front, pos)
                 if t is not None and t[ACTION] == SHIFT:
                     label = featdim
                 featdim += 1
             elif t1[0] == LEFTARC or t1[0] == RIGHTARC:
                     
-                n = len(list1)-1
+                n = top-1
                 si = t1[1]
-                head = buf[0] if t1[0] == LEFTARC else list1[n-si]
-                dep = list1[n-si] if t1[0] == LEFTARC else buf[0]
+                head = front if t1[0] == LEFTARC else n-si
+                dep = n-si if t1[0] == LEFTARC else front
                 #print('checa', head, dep,si)
-                feat[i] = (t1[0], head, dep, buf[0], pos)
+                feat[i] = (t1[0], head, dep, front, pos)
                 if t is not None and t[ACTION] == t1[0] and t[N] == si+1:
                         label = featdim + t[REL]
                    
@@ -385,30 +611,30 @@ def featurize_state(state, mappings, t=None):
         num_ra=0
         for i, t1 in enumerate(possible_trans):
             if t1[0] == SHIFT:
-                feat[i] = (SHIFT, -1, -1, buf[0], pos)
+                feat[i] = (SHIFT, -1, -1, front, pos)
                 if t is not None and t[ACTION] == SHIFT:
                     label = featdim
                 featdim += 1
                 
             elif t1[0] == NOARC:
-                n = len(list1)-1
+                n = top-1
                 si = 0
-                dep = list1[n-si]
-                head = list1[n-si]
+                dep = n-si
+                head = n-si
                 
                 
-                feat[i] = (t1[0], head, dep, buf[0], pos)
+                feat[i] = (t1[0], head, dep, front, pos)
                 if t is not None and t[ACTION] == t1[0]:
                         label = featdim + t[REL]
                 featdim += RELS 
             
             elif t1[0] == LEFTARC or t1[0] == RIGHTARC:
                     
-                n = len(list1)-1
+                n = top-1
                 si = t1[1]
-                head = buf[0] if t1[0] == LEFTARC else list1[n-si]
-                dep = list1[n-si] if t1[0] == LEFTARC else buf[0]
-                feat[i] = (t1[0], head, dep, buf[0], pos)
+                head = front if t1[0] == LEFTARC else n-si
+                dep = n-si if t1[0] == LEFTARC else front
+                feat[i] = (t1[0], head, dep, front, pos)
                 if t is not None and t[ACTION] == t1[0] and t[N] == si+1:
                         label = featdim + t[REL]
                    
@@ -442,28 +668,28 @@ def featurize_state(state, mappings, t=None):
         
         for i, t1 in enumerate(possible_trans):
             if t1[0] == SHIFT:
-                feat[i] = (t1[0], -1, -1, buf[0], pos)
+                feat[i] = (t1[0], -1, -1, front, pos)
                 if t is not None and t[ACTION] == t1[0]:
                     label = featdim
                 featdim += 1
                 
             elif t1[0] == NOARC:
-                n = len(list1)-1
+                n = top-1
                 si = 0
-                dep = list1[n-si]
-                head = list1[n-si]
+                dep = n-si
+                head = n-si
                 
-                feat[i] = (t1[0], head, dep, buf[0], pos)
+                feat[i] = (t1[0], head, dep, front, pos)
                 if t is not None and t[ACTION] == t1[0]:
                         label = featdim + t[REL]
                 featdim += RELS    
                 
             elif t1[0] == LEFTARC or t1[0] == RIGHTARC:
-                n = len(list1)-1
+                n = top-1
                 si = t1[1]
-                head = buf[0] if t1[0] == LEFTARC else list1[n-si]
-                dep = list1[n-si] if t1[0] == LEFTARC else buf[0]
-                feat[i] = (t1[0], head, dep, buf[0], pos)
+                head = front if t1[0] == LEFTARC else n-si
+                dep = n-si if t1[0] == LEFTARC else front
+                feat[i] = (t1[0], head, dep, front, pos)
                 if t is not None and t[ACTION] == t1[0] and t[N] == si+1:
                         label = featdim + t[REL]
                         
@@ -489,26 +715,211 @@ def featurize_state(state, mappings, t=None):
         return feat
     return feat, label
 
-def featurize_transitions(data, mappings, invmappings, feat_file, transsys, log=None):
-    if feat_file is not None and op.exists(feat_file):
-        with smart_open(feat_file, 'rb') as f:
-            res = pickle.load(f)
-            max_feat_size = pickle.load(f)
-
-        log.info('Read %d featurized examples from saved feature file "%s".' % (len(res), feat_file))
-
-        return res, max_feat_size
+def pad_sequences(seqs, lengths=None, dtype=np.int32):
+    """
+    Stacks sequences into a [len(seqs), longest] array padded with zeros,
+    filled with a single masked assignment; their lengths can be passed in
+    if they are known already
+    """
+    if lengths is None:
+        lengths = np.fromiter((len(seq) for seq in seqs), np.int32, len(seqs))
+    res = np.zeros((len(seqs), lengths.max()), dtype=dtype)
+    res[np.arange(lengths.max()) < lengths[:, None]] = np.concatenate(seqs)
+    return res
 
-    log.info('Featurizing %d examples...' % (len(data)))
-    max_feat_size = -1
+def example_arrays(example):
+    """
+    Returns an example with its words and POS tags as int32 arrays, ready
+    to be stacked into batches, and without its oracle sequence, which is
+    only needed in featurized form once featurization is done
+    """
+    return tuple(None if j == 1 else np.asarray(x, dtype=np.int32) for j, x in enumerate(example))
+
+class FeatureStore(object):
+    """
+    Featurized examples as flat int32 arrays: the feature rows of all
+    transition steps, the feature size and label of every step, and
+    offsets from every example into the steps and from every step into the
+    rows. Stores are saved as a directory of .npy files and memory-mapped
+    when loaded, so examples come out as views without copying.
+    """
+    arrays = ['rows', 'sizes', 'labels', 'step_offsets', 'row_offsets']
+
+    def __init__(self, rows, sizes, labels, step_offsets, row_offsets, max_feat_size):
+        self.rows = rows
+        self.sizes = sizes
+        self.labels = labels
+        self.step_offsets = step_offsets
+        self.row_offsets = row_offsets
+        self.max_feat_size = max_feat_size
+
+    @classmethod
+    def from_examples(cls, examples, max_feat_size):
+        """ Packs [feats, featsizes, labels] examples as featurize_transitions builds them """
+        rows, counts, sizes, labels, steps = [], [], [], [], []
+        for feats, featsizes, labs in examples:
+            for feat in feats:
+                # Covington has a single feature tuple per step, the others
+                # one per candidate transition
+                if len(feat) > 0 and isinstance(feat[0], (tuple, list)):
+                    rows.extend(feat)
+                    counts.append(len(feat))
+                else:
+                    rows.append(feat)
+                    counts.append(1)
+            sizes.extend(featsizes)
+            labels.extend(labs)
+            steps.append(len(labs))
+
+        rows = np.array(rows, dtype=np.int32).reshape((-1, 5))
+        step_offsets = np.zeros(len(steps)+1, dtype=np.int32)
+        step_offsets[1:] = np.cumsum(steps)
+        row_offsets = np.zeros(len(counts)+1, dtype=np.int32)
+        row_offsets[1:] = np.cumsum(counts)
+        return cls(rows, np.array(sizes, dtype=np.int32), np.array(labels, dtype=np.int32), step_offsets, row_offsets, max_feat_size)
+
+    @classmethod
+    def looks_like_store(cls, path):
+        """ Whether path is a directory holding nothing but the files of a (possibly partial) store """
+        if not op.isdir(path):
+            return False
+        names = set('%s.npy' % name for name in cls.arrays + ['max_feat_size'])
+        return all(name in names for name in os.listdir(path))
+
+    @classmethod
+    def load(cls, path):
+        arrays = [np.load(op.join(path, '%s.npy' % name), mmap_mode='r') for name in cls.arrays]
+        max_feat_size = int(np.load(op.join(path, 'max_feat_size.npy')))
+        return cls(*(arrays + [max_feat_size]))
+
+    def save(self, path):
+        if not op.exists(path):
+            os.makedirs(path)
+        for name in self.arrays:
+            np.save(op.join(path, '%s.npy' % name), getattr(self, name))
+        np.save(op.join(path, 'max_feat_size.npy'), np.int32(self.max_feat_size))
+
+    def __len__(self):
+        return len(self.step_offsets) - 1
+
+    def example_dims(self, single=False):
+        """
+        Returns the number of transition steps of every example and the
+        largest number of candidate transitions in any of them (1 with
+        single, when steps have a single feature row), the dimensions its
+        features are padded along in a batch
+        """
+        steps = np.diff(self.step_offsets)
+        if single or len(self.sizes) == 0:
+            cands = np.ones_like(steps)
+        else:
+            starts = np.minimum(self.step_offsets[:-1], len(self.sizes) - 1)
+            cands = np.where(steps > 0, np.maximum.reduceat(self.sizes, starts), 0)
+        return np.column_stack([steps, cands])
+
+    @property
+    def max_steps(self):
+        """ The largest number of transition steps in an example """
+        return int(np.diff(self.step_offsets).max()) if len(self) > 0 else -1
+
+    def __getitem__(self, i):
+        """
+        Returns the feature rows, the offsets of every step into them (one
+        more than there are steps), the feature sizes and the labels of
+        example i, followed by the step and the slot within it of every row,
+        so that batches can be filled with a single scatter
+        """
+        s0, s1 = self.step_offsets[i], self.step_offsets[i+1]
+        row_offsets = self.row_offsets[s0:s1+1] - self.row_offsets[s0]
+        r0, r1 = self.row_offsets[s0], self.row_offsets[s1]
+        counts = np.diff(row_offsets)
+        row_steps = np.repeat(np.arange(s1 - s0, dtype=np.int32), counts)
+        row_slots = np.arange(r1 - r0, dtype=np.int32) - np.repeat(row_offsets[:-1], counts)
+        return self.rows[r0:r1], row_offsets, self.sizes[s0:s1], self.labels[s0:s1], row_steps, row_slots
+
+class SeqFile(object):
+    """
+    Oracle sequences in binary form: the vector form of every transition as
+    an int16 (action, n, rel, pos, fpos) record, and the offsets of every
+    sentence into the records, saved as a directory of .npy files and
+    memory-mapped when loaded
+    """
+    def __init__(self, records, offsets):
+        self.records = records
+        self.offsets = offsets
+
+    @classmethod
+    def load(cls, path):
+        return cls(np.load(op.join(path, 'records.npy'), mmap_mode='r'), np.load(op.join(path, 'offsets.npy')))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.records[self.offsets[i]:self.offsets[i+1]]
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    @property
+    def max_steps(self):
+        """ The largest number of transitions in a sentence """
+        return int(np.diff(self.offsets).max()) if len(self) > 0 else -1
+
+class SeqWriter(object):
+    """ Writes a binary sequence file a sentence at a time """
+    def __init__(self, path):
+        self.path = path
+        if not op.exists(path):
+            os.makedirs(path)
+        self.raw = open(op.join(path, 'records.raw'), 'wb')
+        self.offsets = [0]
+
+    def write(self, vector_forms):
+        records = np.array(vector_forms, dtype=np.int32).reshape((-1, len(transition_dims)))
+        assert(np.all(np.abs(records) < (1 << 15)))
+        self.raw.write(records.astype(np.int16).tobytes())
+        self.offsets += [self.offsets[-1] + len(records)]
+
+    def close(self):
+        self.raw.close()
+        _raw_to_npy(op.join(self.path, 'records.raw'), op.join(self.path, 'records.npy'), np.int16, (self.offsets[-1], len(transition_dims)))
+        np.save(op.join(self.path, 'offsets.npy'), np.array(self.offsets, dtype=np.int64))
+
+# sentences sent to a featurization worker at a time
+FEATURIZE_CHUNK_SIZE = 64
+
+_featurize_worker = None
+
+def _init_featurize_worker(transsys, mappings, invmappings, window, gold=False):
+    global _featurize_worker
+    _featurize_worker = (transsys(mappings, invmappings, window=window), mappings, gold)
+
+def _iter_gold_vectors(state, pos, fpos, mappings):
+    """
+    Yields the oracle transitions of a gold parser state in the vector form
+    process_example reads from sequence files, as the caller advances it
+    """
+    transsys = state.transsys
+    while len(state.transitionset()) > 0:
+        yield _fields_to_vector(transsys.trans_to_fields(transsys.goldtransition(state), state, pos, fpos), mappings)
+
+def _featurize_chunk(chunk):
+    """
+    Replays the gold transitions of a list of (sentence, transitions) pairs,
+    or in gold mode runs the oracle on a list of CoNLL sentences and
+    featurizes its transitions in the same pass
+    """
+    transsys, mappings, gold = _featurize_worker
     res = []
-
-    count = 0
-    transsys = transsys(mappings, invmappings)
-
-    for t in data:
-        sent, trans = t[:2]
-        state = ParserState(sent, transsys=transsys)
+    for item in chunk:
+        if gold:
+            state, pos, fpos = gold_parserstate(item, transsys)
+            trans = _iter_gold_vectors(state, pos, fpos, mappings)
+        else:
+            sent, trans = item
+            state = ParserState(sent, transsys=transsys)
 
         feats = []
         labels = []
@@ -517,61 +928,269 @@ def featurize_transitions(data, mappings, invmappings, feat_file, transsys, log=
             feat, label = featurize_state(state, mappings, t)
             transsys.advance(state, label)
 
-            max_feat_size = max(max_feat_size, len(feat))
             feats += [feat]
             labels += [label]
             featsizes += [len(feat)]
 
         assert(len(feats) == len(labels))
         res += [[feats, featsizes, labels]]
+    return res
+
+def _chunks(iterable, size):
+    chunk = []
+    for x in iterable:
+        chunk.append(x)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+def _looks_like_features(path):
+    """ Whether path is a pickle file or a (possibly partial) feature store """
+    return op.isfile(path) or FeatureStore.looks_like_store(path)
+
+def _load_features(feat_file):
+    if op.isdir(feat_file):
+        return FeatureStore.load(feat_file)
+
+    with smart_open(feat_file, 'rb') as f:
+        res = pickle.load(f)
+        max_feat_size = pickle.load(f)
+    return FeatureStore.from_examples(res, max_feat_size)
+
+def featurize_examples(data, mappings, invmappings, transsys, window=0, workers=1, log=None, gold=False):
+    """
+    Replays the gold transitions of a list of examples, returning the
+    [feats, featsizes, labels] of each and the maximum feature size. In gold
+    mode data holds the lines of CoNLL sentences instead, and the gold
+    transitions come straight from the oracle.
+    """
+    if workers <= 0:
+        workers = multiprocessing.cpu_count()
+    log.info('Featurizing %d examples with %d worker(s)...' % (len(data), workers))
+    examples = iter(data) if gold else (t[:2] for t in data)
+    start = last = time.time()
+    res = []
 
-        count += 1
-        if (count) % 100 == 0:
-            log.debug("Featurized %d examples..." % (count))
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, _init_featurize_worker, (transsys, mappings, invmappings, window, gold))
+        chunks = pool.imap(_featurize_chunk, _chunks(examples, FEATURIZE_CHUNK_SIZE))
+    else:
+        pool = None
+        _init_featurize_worker(transsys, mappings, invmappings, window, gold)
+        chunks = (_featurize_chunk(chunk) for chunk in _chunks(examples, FEATURIZE_CHUNK_SIZE))
+
+    # imap hands chunks back in submission order, so the result is the same
+    # as featurizing serially
+    try:
+        for chunk in chunks:
+            res += chunk
+
+            now = time.time()
+            if now - last >= 10 or len(res) == len(data):
+                log.info("Featurized %d/%d examples (%.1f examples/s)" % (len(res), len(data), len(res) / max(now - start, 1e-6)))
+                last = now
+    finally:
+        if pool is not None:
+            # all results are in unless something failed, in which case the
+            # workers must not be left running
+            pool.terminate()
+            pool.join()
+
+    max_feat_size = max([-1] + [max(featsizes) for _, featsizes, _ in res if len(featsizes) > 0])
 
     assert(len(res) == len(data))
     log.info("%d examples featurized, maximum feature size=%d" % (len(res), (max_feat_size-1)*len(mappings['rel'])+1))
 
-    if feat_file is not None:
-        log.info('Saving %d featurized examples to feature file "%s"...' % (len(res), feat_file))
-        with smart_open(feat_file, 'wb') as f:
-            pickle.dump(res, f, pickle.HIGHEST_PROTOCOL)
-            pickle.dump(max_feat_size, f, pickle.HIGHEST_PROTOCOL)
-
-        log.info('Done.')
 
     return res, max_feat_size
 
-def read_gold_parserstates(fin, transsys, fpos=False):
-    def processlines(lines):
-        arcs = [dict() for i in range(len(lines)+1)]
-
-        pos = ["" for i in xrange(len(lines)+1)]
-        fpos = ["" for i in xrange(len(lines)+1)]
+def featurize_transitions(data, mappings, invmappings, feat_file, transsys, log=None, window=0, feat_format='npy', workers=1, cache=None, key=None, gold_file=None, load_unkeyed=False):
+    """
+    Featurizes the oracle transitions of the examples, which come from their
+    sequences, or if gold_file is given, straight from the gold trees in that
+    CoNLL file (the one data was read from)
+    """
+    res = _load_artifact('feats', feat_file, key, cache, _load_features, _looks_like_features, log=log, load_unkeyed=load_unkeyed)
+    if res is not None:
+        log.info('Read %d featurized examples from saved features.' % (len(res)))
+
+        return res, res.max_feat_size
+
+    if gold_file is not None:
+        with smart_open(gold_file, 'r') as f:
+            sentences = list(iter_blocks(f))
+        assert(len(sentences) == len(data))
+        res, max_feat_size = featurize_examples(sentences, mappings, invmappings, transsys, window=window, workers=workers, log=log, gold=True)
+    else:
+        res, max_feat_size = featurize_examples(data, mappings, invmappings, transsys, window=window, workers=workers, log=log)
+    store = FeatureStore.from_examples(res, max_feat_size)
+
+    if feat_file is not None or cache is not None:
+        log.info('Saving %d featurized examples...' % (len(res)))
+
+        def save(path):
+            # the cache always keeps feature stores
+            if path == feat_file and feat_format == 'pickle':
+                with smart_open(path, 'wb') as f:
+                    pickle.dump(res, f, pickle.HIGHEST_PROTOCOL)
+                    pickle.dump(max_feat_size, f, pickle.HIGHEST_PROTOCOL)
+            else:
+                store.save(path)
+        _store_artifact('feats', feat_file, key, cache, save, _looks_like_features)
 
-        for i, line in enumerate(lines):
-            #print('head', line, line[6])
-            pos[i+1] = line[3] # fine-grained
-            fpos[i+1] = line[4]
-            parent = int(line[6])
-            relation = line[7]
-            arcs[parent][i+1] = transsys.mappings['rel'][relation]
+        log.info('Done.')
 
-        res = [ParserState(["<ROOT>"] + lines, transsys=transsys, goldrels=arcs), pos]
-        if fpos:
-            res += [fpos]
-        else:
-            res == [None]
-        return res
-    res = []
+    return store, max_feat_size
+
+def pack_batches(examples, batch_size, budget=0, dims=None):
+    """
+    Cuts a stream of examples into consecutive batches of at most
+    batch_size examples, yielded as soon as they are full. With a budget, a
+    batch also ends before its padded size would exceed it: dims maps an
+    example to the dimensions it is padded along, and a batch takes as many
+    cells as its number of examples times the product of their largest
+    dimensions. An example over the budget on its own gets a batch to itself.
+    """
+    batch = []
+    top = None
+    for t in examples:
+        d = np.asarray(dims(t)) if budget > 0 else None
+        if len(batch) > 0 and (len(batch) == batch_size or (budget > 0 and (len(batch) + 1) * np.prod(np.maximum(top, d)) > budget)):
+            yield batch
+            batch = []
+        if budget > 0:
+            top = d if len(batch) == 0 else np.maximum(top, d)
+        batch.append(t)
+    if len(batch) > 0:
+        yield batch
+
+def iter_batches(examples, batch_size, buckets=1, rng=random, budget=0, dims=None, key=None):
+    """
+    Groups a stream of shuffled (example, features) pairs into batches of
+    similar lengths: buckets batches' worth of examples are read at a time,
+    sorted by sentence and transition length and cut into batches with
+    pack_batches, which come out in a random order. Without a budget every
+    batch holds batch_size examples, and examples that do not fill a last
+    one are dropped. With a budget, the last batch of a window is carried
+    over to the next one, so that batches only end short of the budget at
+    the end of the stream.
+    """
+    if key is None:
+        key = lambda t: (len(t[0][0]), len(t[1][3]))
+    examples = iter(examples)
+    carry = []
+    while True:
+        window = carry + list(islice(examples, batch_size * buckets))
+        if len(window) == len(carry):
+            if len(carry) > 0:
+                yield carry
+            break
+
+        if buckets > 1:
+            window.sort(key=key)
+        batches = list(pack_batches(window, batch_size, budget, dims))
+        if budget > 0:
+            carry = batches.pop()
+        elif len(batches[-1]) < batch_size:
+            batches.pop()
+        rng.shuffle(batches)
+        for batch in batches:
+            yield batch
+
+def count_batches(shapes, batch_size, buckets=1, budget=0, dims=None, key=None, rng=random):
+    """
+    Estimates how many batches iter_batches makes of a pass over examples
+    by batching a shuffle of stand-ins for them, which only need to hold
+    what dims and key read from the examples
+    """
+    shapes = list(shapes)
+    rng.shuffle(shapes)
+    return sum(1 for _ in iter_batches(shapes, batch_size, buckets, rng, budget, dims, key))
+
+class Prefetcher(object):
+    """
+    Iterates over the items of an iterator, which a background thread keeps
+    producing up to size items ahead, so that producing the next items
+    overlaps with working on the current one; with size 0 items are produced
+    on demand instead. wait adds up the seconds spent waiting for items.
+    A consumer that stops before the end calls close to stop the thread.
+    """
+    _end = object()
+
+    def __init__(self, iterable, size):
+        self.iterable = iter(iterable)
+        self.wait = 0.
+        self.queue = None
+        self.thread = None
+        self.stopped = threading.Event()
+        if size > 0:
+            self.queue = Queue.Queue(size)
+            self.thread = threading.Thread(target=self._produce)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _put(self, item):
+        """ Queues an item unless the consumer stopped; returns whether it did """
+        while not self.stopped.is_set():
+            try:
+                # a timeout lets a full queue notice close
+                self.queue.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _produce(self):
+        try:
+            for item in self.iterable:
+                if not self._put((item, None)):
+                    return
+            self._put((self._end, None))
+        except Exception:
+            # handed over to be raised in the consuming thread
+            self._put((self._end, sys.exc_info()))
+
+    def close(self):
+        """ Stops producing items and waits for the thread to finish """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        start = time.time()
+        try:
+            if self.queue is None:
+                return next(self.iterable)
 
+            while True:
+                try:
+                    # a timeout keeps the wait interruptible
+                    item, exc_info = self.queue.get(timeout=1)
+                    break
+                except Queue.Empty:
+                    pass
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if item is self._end:
+                raise StopIteration
+            return item
+        finally:
+            self.wait += time.time() - start
+
+def iter_conll_sentences(fin):
+    """ Yields the lines of every sentence in a CoNLL file, split into fields """
     lines = []
     line = fin.readline().decode('utf-8')
     while line:
         line = line.strip().split()
 
         if len(line) == 0:
-            res += [processlines(lines)]
+            yield lines
             lines = []
         else:
             lines += [line]
@@ -579,10 +1198,88 @@ def read_gold_parserstates(fin, transsys, fpos=False):
         line = fin.readline().decode('utf-8')
 
     if len(lines) > 0:
-        res += [processlines(lines)]
+        yield lines
+
+def gold_parserstate(lines, transsys):
+    """
+    Returns the parser state of a CoNLL sentence with its gold arcs, and its
+    coarse and fine-grained POS tags, which oracle sequences always include
+    """
+    arcs = [dict() for i in range(len(lines)+1)]
+
+    pos = ["" for i in xrange(len(lines)+1)]
+    fpos = ["" for i in xrange(len(lines)+1)]
+
+    for i, line in enumerate(lines):
+        #print('head', line, line[6])
+        pos[i+1] = line[3] # fine-grained
+        fpos[i+1] = line[4]
+        parent = int(line[6])
+        relation = line[7]
+        arcs[parent][i+1] = transsys.mappings['rel'][relation]
+
+    return [ParserState(["<ROOT>"] + lines, transsys=transsys, goldrels=arcs), pos, fpos]
 
+# sentences sent to an oracle worker at a time
+ORACLE_CHUNK_SIZE = 64
+
+_oracle_worker = None
+
+def _init_oracle_worker(transsystems, binary):
+    global _oracle_worker
+    _oracle_worker = (transsystems, binary)
+
+def _oracle_chunk(chunk):
+    """ Writes the oracle sequences of a list of sentences for every transition system """
+    transsystems, binary = _oracle_worker
+    res = []
+    for lines in chunk:
+        outs = []
+        for transsys in transsystems:
+            if binary:
+                outs += [gold_trans_vectors(gold_parserstate(lines, transsys))]
+            else:
+                buf = StringIO()
+                write_gold_trans(gold_parserstate(lines, transsys), buf)
+                outs += [buf.getvalue()]
+        res += [outs]
     return res
 
+def iter_gold_trans(fin, transsystems, workers=1, binary=False):
+    """
+    Yields the oracle sequences of every sentence in a CoNLL file as it is
+    read, as a list with one for each of the transition systems: the text of
+    the sequence, or its transitions in vector form if binary is set. With
+    several workers (0 for one per CPU), sentences are handed out in chunks
+    and only a few chunks per worker are read ahead, so memory stays bounded.
+    """
+    if workers <= 0:
+        workers = multiprocessing.cpu_count()
+    chunks = _chunks(iter_conll_sentences(fin), ORACLE_CHUNK_SIZE)
+
+    if workers <= 1:
+        _init_oracle_worker(transsystems, binary)
+        for chunk in chunks:
+            for outs in _oracle_chunk(chunk):
+                yield outs
+        return
+
+    pool = multiprocessing.Pool(workers, _init_oracle_worker, (transsystems, binary))
+    try:
+        while True:
+            batch = list(islice(chunks, 4 * workers))
+            if len(batch) == 0:
+                break
+
+            # map returns the chunks in order
+            for res in pool.map(_oracle_chunk, batch):
+                for outs in res:
+                    yield outs
+    finally:
+        # also reached when the caller stops early or fails
+        pool.terminate()
+        pool.join()
+
 def write_gold_trans(tpl, fout):
     state, pos, fpos = tpl
     transsys = state.transsys
@@ -596,6 +1293,19 @@ def write_gold_trans(tpl, fout):
     
     fout.write("\n")
 
+def gold_trans_vectors(tpl):
+    """ Returns the oracle transitions of a gold parser state in vector form """
+    state, pos, fpos = tpl
+    transsys = state.transsys
+    res = []
+    while len(state.transitionset()) > 0:
+        t = transsys.goldtransition(state)
+
+        res += [_fields_to_vector(transsys.trans_to_fields(t, state, pos, fpos), transsys.mappings)]
+
+        transsys.advance(state, t)
+    return res
+
 def multi_argmin(lst):
     minval = 1e10
     res = []
@@ -0,0 +1,64 @@
+"""
+Writes random dependency trees in CoNLL format, half of them projective
+(or all of them with --projective), for the tests to run transition
+systems on. The random trees are also used by test_transition.py.
+"""
+
+import random
+import argparse
+
+RELS = ['amod', 'det', 'dobj', 'nsubj']
+POS = ['DT', 'JJ', 'NN', 'VB']
+
+def random_heads(n, rng, projective):
+    """ Returns the head of every word (and -1 for the root) of a random tree over n words """
+    head = [-1] * (n+1)
+    if projective:
+        # cut the span into runs, each the subtree of a word of its own
+        # attached to h
+        def attach(i, j, h):
+            while i < j:
+                e = rng.randint(i+1, j)
+                k = rng.randrange(i, e)
+                head[k] = h
+                attach(i, k, k)
+                attach(k+1, e, k)
+                i = e
+        attach(1, n+1, 0)
+    else:
+        attached = [0]
+        order = range(1, n+1)
+        rng.shuffle(order)
+        for d in order:
+            head[d] = rng.choice(attached)
+            attached.append(d)
+    return head
+
+def random_tree(n, rng, projective):
+    """ Returns the gold arcs (dependent to relation, for every head) of a random tree over n words """
+    goldrels = [dict() for _ in xrange(n+1)]
+    for d, h in enumerate(random_heads(n, rng, projective)):
+        if d > 0:
+            goldrels[h][d] = rng.randrange(len(RELS))
+    return goldrels
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('fileout', type=str, help="Output CoNLL file")
+    parser.add_argument('--sentences', type=int, help="Number of sentences", default=500)
+    parser.add_argument('--max_length', type=int, help="Maximum sentence length", default=30)
+    parser.add_argument('--projective', default=False, action='store_true', help="Only write projective trees")
+    parser.add_argument('--seed', type=int, help="Random seed", default=1)
+
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    with open(args.fileout, 'w') as fout:
+        for i in xrange(args.sentences):
+            n = rng.randint(1, args.max_length)
+            head = random_heads(n, rng, args.projective or i % 2 == 0)
+            for d in xrange(1, n+1):
+                pos = rng.choice(POS)
+                fout.write("%d\tw%d\t_\t%s\t%s\t_\t%d\t%s\t_\t_\n" % (d, rng.randrange(100), pos, pos, head[d], rng.choice(RELS)))
+            fout.write("\n")
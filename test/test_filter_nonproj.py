@@ -0,0 +1,75 @@
+"""
+This script checks the tree statistics of utils/filter_nonproj.py against
+quadratic implementations as obvious as possible on random trees: the
+number of crossing arcs against a test of every pair of arcs, the gap
+degree against the yield of every node collected by walking up the heads,
+and projectivity against a gap degree of 0. Sentences are also run through
+several workers and compared with the serial results. Nothing but the
+names of the checks should be output. It should be run from the root
+directory of the repository.
+"""
+
+import sys
+import os.path as op
+import random
+import argparse
+
+sys.path.insert(0, op.join(op.dirname(op.abspath(__file__)), '..', 'utils'))
+
+from filter_nonproj import preorder, is_projective, crossing_arcs, gap_degree, iter_results
+from random_conll import random_heads
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('--sentences', type=int, help="Number of random sentences per check", default=500)
+parser.add_argument('--max_length', type=int, help="Maximum length of the random sentences", default=20)
+parser.add_argument('--seed', type=int, help="Random seed", default=1)
+
+args = parser.parse_args()
+
+def random_trees(rng):
+    for _ in xrange(args.sentences):
+        yield random_heads(rng.randint(1, args.max_length), rng, rng.random() < 0.5)
+
+def naive_crossing_arcs(heads):
+    arcs = [(min(h, d), max(h, d)) for d, h in enumerate(heads) if d > 0]
+    return sum(1 for a1, b1 in arcs for a2, b2 in arcs if a1 < a2 < b1 < b2)
+
+def naive_gap_degree(heads):
+    res = 0
+    for node in xrange(len(heads)):
+        words = []
+        for x in xrange(len(heads)):
+            y = x
+            while y >= 0 and y != node:
+                y = heads[y]
+            if y == node:
+                words += [x]
+        gaps = sum(1 for a, b in zip(words, words[1:]) if b != a + 1)
+        res = max(res, gaps)
+    return res
+
+def check_stats(rng):
+    for heads in random_trees(rng):
+        order = preorder(heads)
+        assert crossing_arcs(heads) == naive_crossing_arcs(heads), heads
+        assert gap_degree(heads, order) == naive_gap_degree(heads), heads
+        assert is_projective(heads, order) == (naive_gap_degree(heads) == 0), heads
+
+def check_workers(rng):
+    sentences = []
+    for heads in random_trees(rng):
+        sentences += [[[str(d), 'w', '_', '_', '_', '_', str(heads[d]), 'dep'] for d in xrange(1, len(heads))]]
+    serial = list(iter_results(iter(sentences), True, 1))
+    assert list(iter_results(iter(sentences), True, 3)) == serial
+    # stopping early must not leave the workers hanging
+    for item in iter_results(iter(sentences), True, 3):
+        break
+
+checks = [check_stats, check_workers]
+
+for check in checks:
+    print check.__name__
+    check(random.Random(args.seed))
+
+print "Done!"
@@ -0,0 +1,142 @@
+"""
+This script checks that the flattened transition loss of --flat_loss
+gives the same loss and gradients as the loss computed one transition
+step at a time with tf.map_fn, on toy batches of random features for
+Covington and Non-Local Covington. For the latter there are batches with
+and without Shift candidates, and where Shift is the only candidate.
+Nothing but the names of the checks should be output. It should be run
+from the root directory of the repository.
+"""
+
+import sys
+import os.path as op
+import shutil
+import tempfile
+import logging
+import argparse
+
+sys.path.insert(0, op.join(op.dirname(op.abspath(__file__)), '..', 'src'))
+
+import numpy as np
+import tensorflow as tf
+
+from init_argparse import init_argparse
+from parser import Parser
+from utils import transsys_lookup, pad_sequences
+
+tf.logging.set_verbosity(tf.logging.ERROR)
+log = logging.getLogger(__name__)
+
+RELS = ['amod', 'det', 'nsubj']
+POS = ['DT', 'JJ', 'NN', 'VB']
+VOCAB = 20
+
+def make_args(transsys, flat_loss):
+    parser = argparse.ArgumentParser()
+    init_argparse(parser)
+    args = parser.parse_args(['toy.conll', '--transsys', transsys, '--wordvec_dim', '8', '--hidden_size', '8', '--layers', '1', '--layers2', '1',
+                              '--rel_emb_dim', '6', '--pos_emb_dim', '4', '--dense_layers', '8', '--pos_dense_layers', '8', '--keep_prob', '1'])
+    args.flat_loss = flat_loss
+    return args
+
+def make_mappings(transsys):
+    mappings = {'rel': {r: i for i, r in enumerate(RELS)}, 'pos': {p: i for i, p in enumerate(POS)}}
+    invmappings = {'rel': RELS, 'pos': POS}
+    actions = transsys_lookup(transsys).actions_list()
+    mappings['action'] = {k: i for i, k in enumerate(actions)}
+    invmappings['action'] = actions
+    return mappings, invmappings
+
+def toy_step(transsys, mappings, length, rng, shift):
+    """
+    Returns the feature rows and label of a random transition step in a
+    sentence of the given length. With NCov, shift is True for steps that
+    have a Shift candidate, 'only' for steps where it is the only one, and
+    False for steps without.
+    """
+    R = len(RELS)
+    if transsys == 'Cov':
+        # the step-by-step loss cannot gather missing (-1) features on CPU,
+        # so all four point at words
+        return [list(rng.randint(0, length, 4)) + [-1]], rng.randint(2 + 2 * R)
+
+    SHIFT, LEFTARC, RIGHTARC = [mappings['action'][a] for a in ['Shift', 'Left-Arc', 'Right-Arc']]
+    front = rng.randint(1, length)
+    rows = [[SHIFT, -1, -1, front, -1]] if shift else []
+    arcs = 0 if shift == 'only' else rng.randint(1, 4)
+    rows += [[rng.choice([LEFTARC, RIGHTARC]), rng.randint(length), rng.randint(length), front, -1] for _ in xrange(arcs)]
+    if shift and (arcs == 0 or rng.rand() < 0.3):
+        return rows, 0
+    return rows, (1 if shift else 0) + rng.randint(arcs * R)
+
+def toy_feed(parser, transsys, mappings, rng, shift):
+    """ Feeds a random batch of three sentences """
+    lengths = np.array([6, 4, 7], dtype=np.int32)
+    steps = np.array([5, 2, 6], dtype=np.int32)
+    words = pad_sequences([rng.randint(VOCAB, size=n) for n in lengths], lengths)
+    pos = pad_sequences([rng.randint(len(POS), size=n) for n in lengths], lengths)
+
+    examples = []
+    for n, T in zip(lengths, steps):
+        if shift == 'mixed':
+            examples += [[toy_step(transsys, mappings, n, rng, [True, 'only', False][rng.randint(3)]) for _ in xrange(T)]]
+        else:
+            examples += [[toy_step(transsys, mappings, n, rng, shift) for _ in xrange(T)]]
+
+    width = max(len(rows) for ex in examples for rows, _ in ex)
+    shape = [len(lengths), steps.max()] + ([5] if transsys == 'Cov' else [width, 5])
+    feat_ids = np.zeros(shape, dtype=np.int32)
+    sizes = np.zeros(shape[:2], dtype=np.int32)
+    labels = np.zeros(shape[:2], dtype=np.int32)
+    for i, ex in enumerate(examples):
+        for j, (rows, label) in enumerate(ex):
+            feat_ids[i, j] = rows[0] if transsys == 'Cov' else rows + [[0] * 5] * (width - len(rows))
+            sizes[i, j] = len(rows)
+            labels[i, j] = label
+
+    return {parser.words: words, parser.words2: words, parser.sent_lengths: lengths, parser.gold_pos: pos,
+            parser.trans_feat_ids: feat_ids, parser.trans_feat_sizes: sizes, parser.trans_labels: labels, parser.trans_lengths: steps}
+
+def losses_and_gradients(transsys, flat_loss, cases, checkpoint):
+    """
+    Returns the loss and gradients of the parser on the toy batch of every
+    case, with the weights of the checkpoint, which is written first if
+    it does not exist yet
+    """
+    tf.reset_default_graph()
+    tf.set_random_seed(1)
+    rng = np.random.RandomState(1)
+    mappings, invmappings = make_mappings(transsys)
+    vecs = rng.uniform(-1, 1, (VOCAB, 8)).astype(np.float32)
+    parser = Parser(make_args(transsys, flat_loss), vecs, VOCAB / 2, mappings, invmappings, None, None, None, log)
+    variables = tf.trainable_variables()
+    gradients = [tf.convert_to_tensor(g) for g in tf.gradients(parser.loss, variables) if g is not None]
+
+    saver = tf.train.Saver(variables)
+    res = []
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        if op.exists(checkpoint + '.index'):
+            saver.restore(sess, checkpoint)
+        else:
+            saver.save(sess, checkpoint)
+        for shift in cases:
+            res += [sess.run([parser.loss] + gradients, feed_dict=toy_feed(parser, transsys, mappings, np.random.RandomState(2), shift))]
+    return res
+
+tmp = tempfile.mkdtemp()
+try:
+    for transsys, cases in [('Cov', [None]), ('NCov', ['mixed', True, 'only', False])]:
+        print transsys
+        checkpoint = op.join(tmp, transsys)
+        stepwise = losses_and_gradients(transsys, False, cases, checkpoint)
+        flat = losses_and_gradients(transsys, True, cases, checkpoint)
+        for shift, a, b in zip(cases, stepwise, flat):
+            assert len(a) == len(b)
+            assert np.isclose(a[0], b[0], rtol=1e-5), (transsys, shift, a[0], b[0])
+            for ga, gb in zip(a[1:], b[1:]):
+                assert np.allclose(ga, gb, rtol=1e-4, atol=1e-5), (transsys, shift, np.abs(ga - gb).max())
+finally:
+    shutil.rmtree(tmp)
+
+print "Done!"
@@ -0,0 +1,35 @@
+#!/bin/bash
+
+# This script verifies that gen_oracle_seq.py writes exactly the same oracle
+# sequences as a reference revision of this repository, for every transition
+# system, on random projective and non-projective trees written by
+# random_conll.py. The optional first argument is the git revision to compare
+# with (the first commit of the repository by default); the sequences of all
+# systems are generated in one parallel pass with the current code.
+#
+# This script should be run from the root directory of the repository.
+
+rev=${1:-$(git rev-list --max-parents=0 HEAD)}
+python=${PYTHON:-python}
+
+tmp=$(mktemp -d)
+trap "rm -rf $tmp" EXIT
+
+git archive $rev src | tar -x -C $tmp
+$python test/random_conll.py $tmp/random.conll
+bash utils/create_mappings.sh $tmp/random.conll > $tmp/mappings.txt
+
+cd src
+$python gen_oracle_seq.py $tmp/random.conll "$tmp/{transsys}.seq" --transsys Cov,NCov,Cov2,Cov3 --mappings $tmp/mappings.txt --workers 2 || exit 1
+cd $tmp/src
+for transsys in Cov NCov Cov2 Cov3; do
+    $python gen_oracle_seq.py $tmp/random.conll $tmp/$transsys.ref.seq --transsys $transsys --mappings $tmp/mappings.txt || exit 1
+done
+cd $tmp
+
+echo "Taking the diff, nothing should be output"
+for transsys in Cov NCov Cov2 Cov3; do
+    diff -q $transsys.ref.seq $transsys.seq
+done
+
+echo "Done!"
@@ -0,0 +1,80 @@
+"""
+This script checks the Prefetcher that assembles training batches in a
+background thread: items come out in order, an exception raised while
+producing them is raised again in the consuming thread after the items
+before it, with the traceback of the producer, and a consumer that stops
+early can stop the thread, which then produces nothing more. Nothing but
+the names of the checks should be output. It should be run from the root
+directory of the repository.
+"""
+
+import sys
+import os.path as op
+import time
+import threading
+import traceback
+import itertools
+
+sys.path.insert(0, op.join(op.dirname(op.abspath(__file__)), '..', 'src'))
+
+from utils import Prefetcher
+
+SIZES = [0, 1, 4]
+
+def check_items():
+    for size in SIZES:
+        batches = Prefetcher(xrange(100), size)
+        assert list(batches) == range(100), size
+        batches.close()
+
+def failing_source(n):
+    for i in xrange(n):
+        yield i
+    raise ValueError('source failed')
+
+def check_exception():
+    for size in SIZES:
+        batches = Prefetcher(failing_source(3), size)
+        items = []
+        try:
+            for item in batches:
+                items += [item]
+            assert False, 'nothing raised'
+        except ValueError as e:
+            assert str(e) == 'source failed', size
+            assert 'failing_source' in [frame[2] for frame in traceback.extract_tb(sys.exc_info()[2])], size
+        assert items == range(3), (size, items)
+        batches.close()
+
+def check_close():
+    for size in SIZES[1:]:
+        produced = []
+        def source():
+            for i in itertools.count():
+                produced.append(i)
+                yield i
+
+        batches = Prefetcher(source(), size)
+        for expected, item in zip(xrange(5), batches):
+            assert item == expected
+        # close from another thread, so that a producer that never stops
+        # fails the check instead of hanging it; the thread notices within
+        # the timeout of a blocked put
+        closer = threading.Thread(target=batches.close)
+        closer.daemon = True
+        closer.start()
+        closer.join(3)
+        assert not closer.is_alive() and not batches.thread.is_alive(), size
+        # at most the queue and the item blocked on it were produced ahead
+        assert len(produced) <= 5 + size + 1, (size, len(produced))
+        n = len(produced)
+        time.sleep(0.1)
+        assert len(produced) == n, size
+
+checks = [check_items, check_exception, check_close]
+
+for check in checks:
+    print check.__name__
+    check()
+
+print "Done!"
@@ -0,0 +1,64 @@
+"""
+This script checks binary sequence files against text ones, for every
+transition system, on random projective and non-projective trees written
+by random_conll.py: text sequences converted to binary and back with
+convert_seq_file.py must be byte-identical to the originals, binary ones
+written by gen_oracle_seq.py --binary must hold the same records as the
+converted ones, and read_data must read the same examples from either
+format. Nothing but the names of the checks should be output. It should be
+run from the root directory of the repository.
+"""
+
+import sys
+import os.path as op
+import shutil
+import tempfile
+import logging
+import subprocess
+import filecmp
+
+SRC = op.join(op.dirname(op.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+
+import numpy as np
+
+from utils import read_mappings, read_data, transsys_lookup, SeqFile
+
+log = logging.getLogger(__name__)
+
+SYSTEMS = ['Cov', 'NCov', 'Cov2', 'Cov3']
+
+def run(script, *args):
+    subprocess.check_call([sys.executable, script] + list(args), cwd=SRC)
+
+tmp = tempfile.mkdtemp()
+try:
+    conll = op.join(tmp, 'random.conll')
+    mappings_file = op.join(tmp, 'mappings.txt')
+    subprocess.check_call([sys.executable, op.join(op.dirname(op.abspath(__file__)), 'random_conll.py'), conll, '--sentences', '200'])
+    with open(mappings_file, 'w') as f:
+        subprocess.check_call(['bash', 'utils/create_mappings.sh', conll], stdout=f)
+
+    seq = op.join(tmp, '{transsys}')
+    run('gen_oracle_seq.py', conll, seq + '.seq', '--transsys', ','.join(SYSTEMS), '--mappings', mappings_file)
+    run('gen_oracle_seq.py', conll, seq + '.bin', '--transsys', ','.join(SYSTEMS), '--mappings', mappings_file, '--binary')
+
+    vocab = {u'<ROOT>': 0, u'<UNK>': 1}
+    for transsys in SYSTEMS:
+        print transsys
+        text, binary, written = [op.join(tmp, transsys + ext) for ext in ['.seq', '.seq.bin', '.bin']]
+        run('convert_seq_file.py', text, binary, '--transsys', transsys, '--mappings', mappings_file)
+        run('convert_seq_file.py', binary, text + '.txt', '--transsys', transsys, '--mappings', mappings_file)
+        assert filecmp.cmp(text, text + '.txt', shallow=False), transsys
+
+        a, b = SeqFile.load(binary), SeqFile.load(written)
+        assert (a.offsets == b.offsets).all() and (a.records == b.records).all(), transsys
+
+        mappings, _ = read_mappings(mappings_file, transsys_lookup(transsys))
+        from_text = read_data(conll, text, vocab, mappings, transsys_lookup(transsys), fpos=True, log=log)
+        from_binary = read_data(conll, binary, vocab, mappings, transsys_lookup(transsys), fpos=True, log=log)
+        assert from_text == from_binary, transsys
+finally:
+    shutil.rmtree(tmp)
+
+print "Done!"
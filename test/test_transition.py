@@ -0,0 +1,229 @@
+"""
+This script checks the transition systems against implementations as
+obvious as possible, much like test_oracle.py does for oracle sequences:
+random legal transitions are taken on random sentences, and every state
+reached is compared with the straightforward answer. Nothing but the
+names of the checks should be output. It should be run from the root
+directory of the repository.
+"""
+
+import sys
+import os.path as op
+import random
+import argparse
+
+sys.path.insert(0, op.join(op.dirname(op.abspath(__file__)), '..', 'src'))
+
+from parserstate import ParserState
+from transition import Covington, NewCovington, Covington2, Covington3, BatchedNewCovington
+from utils import featurize_state
+from random_conll import RELS, random_tree
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('--sentences', type=int, help="Number of random sentences per check and transition system", default=200)
+parser.add_argument('--max_length', type=int, help="Maximum length of the random sentences", default=12)
+parser.add_argument('--seed', type=int, help="Random seed", default=1)
+
+args = parser.parse_args()
+
+def make_transsys(cls, **kwargs):
+    mappings = {'rel': {r: i for i, r in enumerate(RELS)}, 'pos': {'NN': 0}, 'fpos': {'NN': 0}}
+    invmappings = {'rel': RELS, 'pos': ['NN'], 'fpos': ['NN']}
+    mappings['action'] = {k: i for i, k in enumerate(cls.actions_list())}
+    invmappings['action'] = cls.actions_list()
+    return cls(mappings, invmappings, **kwargs)
+
+def random_states(transsys, rng):
+    """ Yields every state of random legal transition sequences on random sentences """
+    for _ in xrange(args.sentences):
+        n = rng.randint(1, args.max_length)
+        goldrels = random_tree(n, rng, rng.random() < 0.5)
+        state = ParserState(['<ROOT>'] + ['w'] * n, transsys=transsys, goldrels=goldrels)
+        yield state
+        while len(state.transitionset()) > 0:
+            t = rng.choice(state.transitionset())
+            transsys.advance(state, t + (rng.randrange(len(RELS)),))
+            yield state
+
+ALL_SYSTEMS = [Covington, NewCovington, Covington2, Covington3]
+
+"""
+Cycle checks: create_cycles and the partial tree roots come from
+union-find links, and are compared with walks up the heads.
+"""
+def naive_create_cycles(state, h, d):
+    while h >= 0:
+        if h == d:
+            return True
+        h = state.head[h]
+    return False
+
+def naive_root(state, x):
+    while state.head[x] >= 0:
+        x = state.head[x]
+    return x
+
+def check_cycles(rng):
+    for cls in ALL_SYSTEMS:
+        transsys = make_transsys(cls)
+        for state in random_states(transsys, rng):
+            for x in xrange(state.length):
+                assert state.tree_root(x) == naive_root(state, x), (cls.__name__, list(state.head), x)
+                if state.head[x] >= 0:
+                    continue
+                # cycle checks are only asked for dependents with no head
+                for h in xrange(-1, state.length):
+                    assert transsys.create_cycles(state, h, x) == naive_create_cycles(state, h, x), (cls.__name__, list(state.head), h, x)
+
+"""
+NCov transition sets: after arcs they are updated from the delta of the
+previous set, and are compared with sets built from scratch the way the
+transition system is defined.
+"""
+def naive_ncov_transitionset(transsys, state):
+    SHIFT = transsys.mappings['action']['Shift']
+    LEFTARC = transsys.mappings['action']['Left-Arc']
+    RIGHTARC = transsys.mappings['action']['Right-Arc']
+    front = state.front
+    if front >= state.length:
+        return []
+
+    list1 = range(state.top)
+    span = len(list1) if transsys.window <= 0 else min(len(list1), transsys.window)
+    t = [(SHIFT, -1)]
+    for si in xrange(span):
+        l = list1[len(list1)-1-si]
+        if l != 0 and state.head[l] < 0 and not naive_create_cycles(state, state.head[front], l):
+            t += [(LEFTARC, si)]
+    for si in xrange(span):
+        l = list1[len(list1)-1-si]
+        if state.head[front] < 0 and not naive_create_cycles(state, state.head[l], front):
+            t += [(RIGHTARC, si)]
+    return t
+
+def check_ncov_transitionset(rng):
+    for window in [0, 1, 3]:
+        transsys = make_transsys(NewCovington, window=window)
+        for state in random_states(transsys, rng):
+            assert state.transitionset() == naive_ncov_transitionset(transsys, state), (window, list(state.head), state.top, state.front, state.transitionset())
+
+"""
+Legality masks: an output index is legal if and only if it decodes to a
+transition in the transition set.
+"""
+def naive_mask(transsys, state, size):
+    mask = []
+    for i in xrange(size):
+        try:
+            a, _ = transsys.tuple_trans_from_int(state.transitionset(), i)
+            mask += [int(a in state.transitionset())]
+        except (IndexError, UnboundLocalError):
+            # past the end of the transition set or of the layout
+            mask += [0]
+    return mask
+
+def check_masks(rng):
+    size = 2 + (2 * args.max_length + 2) * len(RELS)
+    for cls in ALL_SYSTEMS:
+        transsys = make_transsys(cls)
+        for state in random_states(transsys, rng):
+            masks = transsys.transition_masks([state, state], size)
+            assert list(masks[0]) == naive_mask(transsys, state, size) and list(masks[1]) == list(masks[0]), (cls.__name__, state.transitionset())
+
+"""
+Batched NCov: every row of a BatchedNewCovington follows a ParserState of
+its own, and both are moved through the same random beam steps (rows
+taking over the state of a random parent, then a random legal action).
+Masks, features, heads, relations, roots and built arcs must agree.
+"""
+def check_batched_ncov(rng):
+    size = 1 + 2 * args.max_length * len(RELS)
+    feat_dim = 2 * args.max_length + 1
+    for window in [0, 2]:
+        transsys = make_transsys(NewCovington, window=window)
+        for _ in xrange(args.sentences / 10):
+            lengths = [rng.randint(1, args.max_length) + 1 for _ in xrange(rng.randint(1, 8))]
+            states = [ParserState(['<ROOT>'] + ['w'] * (n-1), transsys=transsys) for n in lengths]
+            engine = BatchedNewCovington(transsys, lengths)
+            while True:
+                masks = engine.transition_masks(size)
+                assert (masks == transsys.transition_masks(states, size)).all(), window
+
+                feats, sizes = engine.featurize(feat_dim)
+                for r, state in enumerate(states):
+                    feat = featurize_state(state, transsys.mappings)
+                    assert sizes[r] == len(feat) and [tuple(x) for x in feats[r, :len(feat)]] == feat, (window, feats[r], feat)
+                    assert not feats[r, len(feat):].any()
+
+                live = [r for r in xrange(len(states)) if masks[r].any()]
+                if len(live) == 0:
+                    break
+                parents = [rng.choice(live) for _ in states]
+                actions = [int(rng.choice(masks[p].nonzero()[0])) if rng.random() < 0.9 else -1 for p in parents]
+                heads, deps, rels = engine.advance(actions, parents)
+
+                states = [states[p].clone() for p in parents]
+                for r, state in enumerate(states):
+                    arc = transsys.advance(state, actions[r]) if actions[r] >= 0 else None
+                    assert (heads[r], deps[r], rels[r]) == (arc or (-1, -1, -1)), (window, arc, heads[r], deps[r], rels[r])
+                    assert (engine.top[r], engine.front[r]) == (state.top, state.front)
+                    n = state.length
+                    assert list(engine.head[r, :n]) == list(state.head) and list(engine.rel[r, :n]) == list(state.rel)
+                    assert list(engine.root[r, :n]) == [state.tree_root(x) for x in xrange(n)]
+
+"""
+Oracles: their questions about list1 are answered from a per-sentence
+index of the gold arcs, and are compared with scans of list1. This holds
+in any state, not only on the gold path.
+"""
+def naive_gold(transsys, state):
+    SHIFT = transsys.mappings['action']['Shift']
+    LEFTARC = transsys.mappings['action']['Left-Arc']
+    RIGHTARC = transsys.mappings['action']['Right-Arc']
+    NOARC = transsys.mappings['action'].get('NoArc')
+    goldrels = state.goldrels
+    list1 = range(state.top)
+    r = state.front
+    # how deep into list1 the oracle looks for an arc
+    reach = {NewCovington: len(list1), Covington3: 3}.get(type(transsys), 1)
+    if isinstance(transsys, NewCovington) and transsys.window > 0:
+        reach = min(reach, transsys.window)
+
+    if len(list1) == 0:
+        return (SHIFT, -1) if isinstance(transsys, Covington) else (SHIFT, -1, -1)
+    for si in xrange(min(reach, len(list1))):
+        l = list1[len(list1)-1-si]
+        if l in goldrels[r]:
+            return (LEFTARC, goldrels[r][l]) if isinstance(transsys, Covington) else (LEFTARC, si, goldrels[r][l])
+        if r in goldrels[l]:
+            return (RIGHTARC, goldrels[l][r]) if isinstance(transsys, Covington) else (RIGHTARC, si, goldrels[l][r])
+    if isinstance(transsys, NewCovington):
+        return (SHIFT, -1, -1)
+
+    noleftchildren = not any(x in goldrels[r] for x in list1)
+    norighthead = not any(r in goldrels[x] for x in list1)
+    if norighthead and noleftchildren:
+        return (SHIFT, -1) if isinstance(transsys, Covington) else (SHIFT, -1, -1)
+    return (NOARC, -1) if isinstance(transsys, Covington) else (NOARC, 0, 1)
+
+def check_gold(rng):
+    systems = [make_transsys(cls) for cls in ALL_SYSTEMS] + [make_transsys(NewCovington, window=w) for w in [1, 3]]
+    for transsys in systems:
+        for state in random_states(transsys, rng):
+            if len(state.transitionset()) == 0:
+                continue
+            goldrels, goldhead, leftmost, left = transsys._goldindex(state, state.goldrels)
+            for x in xrange(state.length):
+                assert goldhead[x] == ([h for h in xrange(state.length) if x in goldrels[h]] + [-1])[0]
+                assert leftmost[x] == min(list(goldrels[x]) + [state.length])
+                assert left[x] == sorted(y for y in xrange(x) if y in goldrels[x] or x in goldrels[y])
+            assert transsys.goldtransition(state) == naive_gold(transsys, state), (type(transsys).__name__, transsys.window, state.goldrels, state.top, state.front)
+
+checks = [check_cycles, check_ncov_transitionset, check_masks, check_batched_ncov, check_gold]
+
+for check in checks:
+    print check.__name__
+    check(random.Random(args.seed))
+
+print "Done!"
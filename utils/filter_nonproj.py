@@ -1,59 +1,171 @@
-import sys
-
-filein = sys.argv[1]
-fileout = sys.argv[2]
-
-def processlines(lines, fout):
-    projective = True
-
-    # find decendents
-    words = ['ROOT']
+"""
+Filters non-projective trees out of a CoNLL file, reading and writing it one
+sentence at a time. Optionally writes the number of crossing arcs and the gap
+degree of every sentence to a separate file.
+"""
+
+import argparse
+import multiprocessing
+from itertools import islice
+
+# sentences sent to a worker at a time
+CHUNK_SIZE = 256
+
+class BIT(object):
+    """ Fenwick tree over positions 0..n-1 for prefix counts """
+    def __init__(self, n):
+        self.tree = [0] * (n + 1)
+
+    def add(self, i):
+        i += 1
+        while i < len(self.tree):
+            self.tree[i] += 1
+            i += i & -i
+
+    def prefix(self, i):
+        """ Number of positions added in 0..i """
+        res = 0
+        i += 1
+        while i > 0:
+            res += self.tree[i]
+            i -= i & -i
+        return res
+
+def read_heads(lines):
+    """ Returns the head of every word, with the root at 0 (its head is -1) """
+    heads = [-1]
     for line in lines:
-        words += [line[1]]
-
-    children = [[] for i in xrange(len(words))]
-    for i, line in enumerate(lines):
         try:
-            parent = int(line[6])
-            relation = line[7]
-            children[parent] += [(relation, i+1)]
+            heads += [int(line[6])]
         except Exception:
             print line
+            heads += [-1]
+    return heads
+
+def preorder(heads):
+    """
+    Returns the nodes of the tree in depth-first order from the root, or
+    None if the heads do not form a tree rooted at 0
+    """
+    n = len(heads)
+    children = [[] for i in xrange(n)]
+    for d in xrange(1, n):
+        if not 0 <= heads[d] < n:
+            return None
+        children[heads[d]] += [d]
+
+    order = []
+    stack = [0]
+    while stack:
+        node = stack.pop()
+        order += [node]
+        stack.extend(reversed(children[node]))
+
+    # words on a cycle are never reached from the root
+    if len(order) != n:
+        return None
+    return order
+
+def is_projective(heads, order):
+    """
+    A tree is projective iff the yield of every node is a contiguous span,
+    i.e. its leftmost and rightmost descendants are size-1 apart; this is
+    checked bottom-up in a single pass
+    """
+    n = len(heads)
+    size = [1] * n
+    lo = range(n)
+    hi = range(n)
+    for node in reversed(order):
+        if hi[node] - lo[node] + 1 != size[node]:
+            return False
+        h = heads[node]
+        if h >= 0:
+            size[h] += size[node]
+            lo[h] = min(lo[h], lo[node])
+            hi[h] = max(hi[h], hi[node])
+    return True
+
+def crossing_arcs(heads):
+    """
+    Counts pairs of crossing arcs (a1, b1), (a2, b2) with a1 < a2 < b1 < b2 by
+    sweeping the arcs by their left ends and counting the right ends of those
+    already seen that fall strictly inside the current arc
+    """
+    arcs = sorted((min(h, d), max(h, d)) for d, h in enumerate(heads) if d > 0)
+    seen = BIT(len(heads))
+    res = 0
+    i = 0
+    while i < len(arcs):
+        # arcs sharing their left end do not cross each other
+        j = i
+        while j < len(arcs) and arcs[j][0] == arcs[i][0]:
+            j += 1
+        for a, b in arcs[i:j]:
+            res += seen.prefix(b-1) - seen.prefix(a)
+        for a, b in arcs[i:j]:
+            seen.add(b)
+        i = j
+    return res
+
+def gap_degree(heads, order):
+    """
+    The largest number of gaps in the yield of a node. The yield of a node
+    is a range of the depth-first order, and it has one block for every word
+    p in it whose left neighbour p-1 is not, so the neighbouring pairs that
+    fall inside each range are counted in an offline sweep
+    """
+    n = len(heads)
+    pos = [0] * n
+    for i, node in enumerate(order):
+        pos[node] = i
+
+    size = [1] * n
+    for node in reversed(order):
+        if heads[node] >= 0:
+            size[heads[node]] += size[node]
+
+    # neighbouring pair (p-1, p) as the point (pos[p], pos[p-1])
+    points = [None] * n
+    for p in xrange(1, n):
+        points[pos[p]] = pos[p-1]
+
+    # pairs inside the range [L, R] of a node: those with x <= R minus those
+    # with x <= L-1, both with L <= y <= R
+    queries = [[] for i in xrange(n)]
+    for node in xrange(n):
+        L, R = pos[node], pos[node] + size[node] - 1
+        queries[R] += [(node, 1, L, R)]
+        if L > 0:
+            queries[L-1] += [(node, -1, L, R)]
+
+    inside = [0] * n
+    ys = BIT(n)
+    for x in xrange(n):
+        if points[x] is not None:
+            ys.add(points[x])
+        for node, sign, L, R in queries[x]:
+            inside[node] += sign * (ys.prefix(R) - ys.prefix(L-1))
+
+    return max(size[node] - inside[node] - 1 for node in xrange(n))
+
+def process_chunk(args):
+    """ Returns whether every sentence is projective, and its statistics if asked for """
+    chunk, stats = args
+    res = []
+    for lines in chunk:
+        heads = read_heads(lines)
+        order = preorder(heads)
+        projective = order is not None and is_projective(heads, order)
+        if stats and order is not None:
+            res += [(projective, (crossing_arcs(heads), gap_degree(heads, order)))]
+        else:
+            res += [(projective, None)]
+    return res
 
-    decendents = [set([child[1] for child in children[i]]) for i in xrange(len(words))]
-
-    change = True
-    while change:
-        change = False
-        for i in xrange(len(decendents)):
-            update = []
-            for d in decendents[i]:
-                for d1 in decendents[d]:
-                    if d1 not in decendents[i]:
-                        update += [d1]
-            if len(update) > 0:
-                decendents[i].update(update)
-                change = True
-
-    for i, node in enumerate(children):
-        for child in node:
-            childid = child[1]
-            for j in xrange(min(childid, i)+1, max(childid, i)):
-                if j not in decendents[i]:
-                    projective = False
-                    return 1
-
-    if projective:
-        fout.write((u"%s\n\n" % (u"\n".join([u"\t".join(line) for line in lines]))).encode('utf-8'))
-
-    return 0
-
-count = 0
-nonproj = 0
-lines = []
-
-fout = open(fileout, 'w')
-with open(filein, 'r') as fin:
+def iter_sentences(fin):
+    """ Yields the lines of every sentence, skipping comments and multiword tokens """
+    lines = []
     line = fin.readline().decode('utf-8')
     while line:
         if line.startswith('#'):
@@ -65,8 +177,7 @@ with open(filein, 'r') as fin:
             continue
 
         if len(line) == 0:
-            count += 1
-            nonproj += processlines(lines, fout)
+            yield lines
             lines = []
         else:
             lines += [line]
@@ -74,8 +185,63 @@ with open(filein, 'r') as fin:
         line = fin.readline().decode('utf-8')
 
     if len(lines) > 0:
-        processlines(lines)
+        yield lines
+
+def iter_results(sentences, stats, workers):
+    """ Yields every sentence with its results, in order """
+    chunks = iter(lambda: list(islice(sentences, CHUNK_SIZE)), [])
+    if workers <= 1:
+        for chunk in chunks:
+            for item in zip(chunk, process_chunk((chunk, stats))):
+                yield item
+        return
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        while True:
+            # read a few chunks ahead per worker so memory stays bounded
+            batch = list(islice(chunks, 4 * workers))
+            if len(batch) == 0:
+                break
+            for chunk, res in zip(batch, pool.map(process_chunk, [(chunk, stats) for chunk in batch])):
+                for item in zip(chunk, res):
+                    yield item
+    finally:
+        # the caller may stop reading before the end of the file
+        pool.terminate()
+        pool.join()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('filein', type=str, help="Input CoNLL file")
+    parser.add_argument('fileout', type=str, help="Output CoNLL file with only the projective trees")
+    parser.add_argument('--stats', type=str, default=None, help="Also write the number of crossing arcs and the gap degree of every sentence to this file")
+    parser.add_argument('--workers', type=int, default=1, help="Number of processes to check the trees with")
+
+    args = parser.parse_args()
+
+    count = 0
+    nonproj = 0
+
+    fstats = open(args.stats, 'w') if args.stats is not None else None
+    if fstats is not None:
+        fstats.write("sentence\twords\tprojective\tcrossing_arcs\tgap_degree\n")
+
+    with open(args.filein, 'r') as fin, open(args.fileout, 'w') as fout:
+        for lines, (projective, stats) in iter_results(iter_sentences(fin), fstats is not None, args.workers):
+            count += 1
+            if projective:
+                fout.write((u"%s\n\n" % (u"\n".join([u"\t".join(line) for line in lines]))).encode('utf-8'))
+            else:
+                nonproj += 1
+
+            if fstats is not None:
+                # malformed trees have no statistics
+                crossings, gaps = stats if stats is not None else ('-', '-')
+                fstats.write("%d\t%d\t%d\t%s\t%s\n" % (count, len(lines), projective, crossings, gaps))
 
-fout.close()
+    if fstats is not None:
+        fstats.close()
 
-print "%d trees processed, %d non-projective trees filtered out" % (count, nonproj)
+    print "%d trees processed, %d non-projective trees filtered out" % (count, nonproj)